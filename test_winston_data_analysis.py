@@ -0,0 +1,160 @@
+"""Tests for the vectorized survey analysis: equivalence with the original per-row scoring, streamed and incremental
+totals, weighting, and willingness-to-pay edge cases. Run with: python -m pytest -q"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import winston_data_analysis as wda
+
+@pytest.fixture(scope="module")
+def survey():
+  '''A cleaned synthetic survey 1 export'''
+  return wda.cleaner1(wda.syntheticSurvey1(3000, seed=1))
+
+def iterrowsFeatureScore(df_clean):
+  '''The original per-row feature scoring, kept as the reference the vectorized scores must match exactly'''
+
+  features_only = df_clean[[column for column, _, _ in wda.SURV1_FEATURE_PAIRS]].dropna()
+
+  data = []
+  for index, row in features_only.iterrows():
+    score_hold = {"AC": 0, "RR": 0, "CR": 0, "SGT": 0, "JA": 0}
+    for column, first, second in wda.SURV1_FEATURE_PAIRS:
+      if row[column] == 1:
+        score_hold[first] += 1
+      else:
+        score_hold[second] += 1
+    data.append(list(score_hold.values()))
+
+  return pd.DataFrame(data, columns=["AC", "RR", "CR", "SGT", "JA"], index=features_only.index)
+
+def iterrowsPerGroup(df_clean, column, levels):
+  return [list(iterrowsFeatureScore(df_clean[df_clean[column] == level]).sum()) for level in levels]
+
+"""## Feature scoring"""
+
+def test_feature_score_matches_iterrows(survey):
+  pd.testing.assert_frame_equal(wda.surv1FeatureScore(survey), iterrowsFeatureScore(survey), check_dtype=False)
+
+def test_grouped_scores_match_iterrows(survey):
+  assert wda.surv1FeatScorePerPB(survey) == iterrowsPerGroup(survey, "Pay Question", range(1, 8))
+  assert wda.surv1FeatScorePerBS(survey) == iterrowsPerGroup(survey, "Buy Question", range(1, 5))
+  assert wda.surv1FeatScoreTotal(survey).tolist() == list(iterrowsFeatureScore(survey).sum())
+
+def test_empty_pay_bracket_scores_zero(survey):
+  without_top_bracket = survey[survey["Pay Question"] != 7]
+  assert wda.surv1FeatScorePerPB(without_top_bracket)[-1] == [0, 0, 0, 0, 0]
+
+"""## Streaming and incremental refresh"""
+
+@pytest.fixture()
+def export(tmp_path):
+  '''Path of a synthetic export, and its cleaned contents'''
+
+  path = str(tmp_path / "survey.csv")
+  df_raw = wda.syntheticSurvey1(2500, seed=2)
+  df_raw.to_csv(path, index=False)
+  return path, wda.cleaner1(df_raw)
+
+def test_streamed_totals_match_in_memory(export):
+  path, df_clean = export
+  accumulator = wda.streamSurvey1(path, chunksize=700)
+
+  assert accumulator.respondents == len(wda.surv1FeatureScore(df_clean))
+  assert accumulator.featScore().tolist() == wda.surv1FeatureScore(df_clean).sum().tolist()
+  assert accumulator.featScorePerPB() == wda.surv1FeatScorePerPB(df_clean)
+  assert accumulator.featScorePerBS() == wda.surv1FeatScorePerBS(df_clean)
+
+def test_incremental_refresh_only_scores_new_respondents(tmp_path, export):
+  path, df_clean = export
+  df_raw = pd.read_csv(path)
+  partial_path = str(tmp_path / "partial.csv")
+  df_raw.iloc[:1001].to_csv(partial_path, index=False) # Label row and the first 1000 respondents
+
+  state_path = str(tmp_path / "state.json")
+  scores = wda.IncrementalFeatureScores(state_path)
+  first = scores.refresh("live", partial_path, chunksize=300)
+  scores.save()
+
+  scores = wda.IncrementalFeatureScores(state_path) # Resume from the saved state
+  second = scores.refresh("live", path, chunksize=300)
+  assert scores.refresh("live", path, chunksize=300) == 0
+
+  full = wda.streamSurvey1(path)
+  assert first + second == full.respondents
+  assert scores.cohorts["live"].toDict() == full.toDict()
+
+"""## Weighting"""
+
+def test_weighted_streaming_matches_in_memory(export):
+  path, df_clean = export
+  weights = wda.rakeWeights(df_clean, {"Q1": {code: code for code in range(1, 8)}})
+
+  accumulator = wda.streamSurvey1(path, chunksize=700, weights=weights)
+
+  np.testing.assert_allclose(accumulator.featScore(), wda.surv1FeatScoreTotal(df_clean, weights))
+  np.testing.assert_allclose(accumulator.featScorePerPB(), wda.surv1FeatScorePerPB(df_clean, weights))
+  with pytest.raises(ValueError):
+    accumulator.toDict()
+
+def test_raking_matches_targets(survey):
+  targets = {"Q1": {code: code for code in range(1, 8)}, "Q2": {code: 8 - code for code in range(1, 8)}}
+  weights = wda.rakeWeights(survey, targets)
+
+  assert weights.mean() == pytest.approx(1)
+  for column, target in targets.items():
+    shares = weights.groupby(survey[column]).sum() / weights.sum()
+    np.testing.assert_allclose(shares.loc[list(target)], np.array(list(target.values())) / sum(target.values()), atol=1e-6)
+
+def test_raking_warns_when_not_converged(survey):
+  with pytest.warns(RuntimeWarning, match="did not converge"):
+    wda.rakeWeights(survey, {"Q1": {code: code for code in range(1, 8)}, "Q2": {code: 8 - code for code in range(1, 8)}}, max_iter=1)
+
+"""## Bradley-Terry utilities"""
+
+def test_utilities_of_empty_cohort(survey):
+  empty = wda.surv1FeatureScore(survey).iloc[:0]
+
+  with warnings.catch_warnings():
+    warnings.simplefilter("error")
+    assert wda.surv1CohortUtilities(empty).isna().all()
+    assert wda.surv1RespondentUtilities(empty).shape == (0, len(wda.SURV1_FEATURES))
+
+"""## Willingness to pay"""
+
+@pytest.fixture(scope="module")
+def engine(survey):
+  return wda.WillingnessToPay(survey)
+
+def test_bundle_demand_matches_per_feature_willingness(survey, engine):
+  feature_scores = engine.feature_scores
+  willingness = np.array(wda.PAY_BRACKET_MIN_PRICES)[survey.loc[feature_scores.index, "Pay Question"].to_numpy() - 1]
+  value = willingness * feature_scores[["AC", "RR"]].sum(axis=1).to_numpy() / feature_scores.sum(axis=1).to_numpy()
+
+  for price in engine.prices:
+    assert engine.bundleDemand().loc["AC+RR", price] == pytest.approx((value >= price - 1e-9).mean())
+
+def test_full_bundle_is_the_demand_curve(engine):
+  np.testing.assert_allclose(engine.bundleDemand().loc["+".join(wda.SURV1_FEATURES)], engine.demandCurve()["share"])
+
+def test_bundle_sweep_compares_bundles_that_leave_a_free_tier(engine):
+  sweep = engine.bundleSweep()
+
+  assert sweep.index.tolist() == [1, 2, 3, 4]
+  assert (sweep["upgrade_share"] > 0).all()
+  assert all(len(row.bundle.split("+")) == size and set(row.bundle.split("+")).isdisjoint(row.free_tier.split("+"))
+             for size, row in sweep.iterrows())
+
+def test_willingness_to_pay_of_empty_cohort(engine):
+  empty = np.zeros(len(engine.feature_scores), dtype=bool)
+
+  with warnings.catch_warnings():
+    warnings.simplefilter("error")
+    assert engine.demandCurve(empty)["share"].isna().all()
+    assert engine.optimalPrice(empty).isna().all()
+    assert engine.bundleDemand(empty).isna().all().all()
+    assert engine.bundleSweep(empty).empty
+    assert wda.sweepCohortBundles({"empty": (engine, empty), "all": (engine, None)}).index.get_level_values("cohort").unique().tolist() == ["all"]
@@ -28,444 +28,1770 @@ Questions we want to answer:
 
 """
 
-from google.colab import drive
-drive.mount("/content/drive", force_remount=True)
+import argparse
+import contextlib
+import cProfile
+import dataclasses
+import functools
+import glob
+import hashlib
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
 import csv
 
+# matplotlib and google.colab are imported inside the functions that need them, so scoring-only runs never load them
+
+def mountGoogleDrive(mount_point="/content/drive"):
+  '''Function that mounts Google Drive when running on Google Colaboratory'''
+
+  from google.colab import drive
+  drive.mount(mount_point, force_remount=True)
+
+"""# Instrumentation"""
+
+# Opt-in stage trace. While disabled, instrumented functions cost one dictionary lookup per call
+TRACE = {"enabled": False, "memory": False, "stages": [], "profiler": None, "_open": []}
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+  '''Context manager that records one pipeline stage in the trace: wall time, CPU time, rows in/out/dropped and,
+  when memory tracing is on, peak traced memory (including nested stages). Yields the stage record, so the body can set "rows_out".
+  Does nothing while instrumentation is disabled.'''
+
+  if not TRACE["enabled"]:
+    yield {}
+    return
+
+  record = {"stage": name, "rows_in": rows_in, "rows_out": None}
+  open_stages = TRACE["_open"]
+
+  if TRACE["memory"]:
+    # Fold the peak so far into the enclosing stage before resetting it for this one
+    if open_stages:
+      open_stages[-1]["peak"] = max(open_stages[-1]["peak"], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    open_stages.append({"peak": 0})
+
+  wall_start, cpu_start = time.perf_counter(), time.process_time()
+  try:
+    yield record
+  finally:
+    record["wall_seconds"] = time.perf_counter() - wall_start
+    record["cpu_seconds"] = time.process_time() - cpu_start
+
+    if record["rows_in"] is not None and record["rows_out"] is not None:
+      record["rows_dropped"] = record["rows_in"] - record["rows_out"]
+
+    if TRACE["memory"]:
+      peak = max(open_stages.pop()["peak"], tracemalloc.get_traced_memory()[1])
+      record["peak_bytes"] = peak - memory_start
+      if open_stages:
+        open_stages[-1]["peak"] = max(open_stages[-1]["peak"], peak)
+
+    TRACE["stages"].append(record)
+
+def instrumented(name=None, filters_rows=False):
+  '''Decorator that records every call of a function as a stage (see stage()).
+  optional arguments: name=str; stage name, defaults to the function name
+                      filters_rows=bool; the function returns a subset of the rows of its DataFrame first argument,
+                                         so rows in, out and dropped are recorded'''
+
+  def decorator(function):
+    stage_name = name or function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not TRACE["enabled"]:
+        return function(*args, **kwargs)
+
+      rows_in = len(args[0]) if args and isinstance(args[0], pd.DataFrame) else None
+      with stage(stage_name, rows_in) as record:
+        result = function(*args, **kwargs)
+        if filters_rows and isinstance(result, pd.DataFrame):
+          record["rows_out"] = len(result)
+      return result
+
+    return wrapper
+
+  return decorator
+
+def enableInstrumentation(memory=False, profile=False):
+  '''Function that starts recording stages into a fresh trace.
+  optional arguments: memory=bool; trace peak memory with tracemalloc (slows allocation-heavy code)
+                      profile=bool; also run cProfile over everything until disableInstrumentation()'''
+
+  TRACE.update(enabled=True, memory=memory, stages=[], _open=[])
+
+  if memory and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+  if profile:
+    TRACE["profiler"] = cProfile.Profile()
+    TRACE["profiler"].enable()
+
+def disableInstrumentation(trace_path=None, profile_path=None):
+  '''Function that stops recording and returns the trace as a list of stage records.
+  optional arguments: trace_path=str; write the trace there as JSON
+                      profile_path=str; write the cProfile statistics there (readable with pstats or snakeviz)'''
+
+  if TRACE["profiler"] is not None:
+    TRACE["profiler"].disable()
+    if profile_path is not None:
+      TRACE["profiler"].dump_stats(profile_path)
+    TRACE["profiler"] = None
+
+  if TRACE["memory"] and tracemalloc.is_tracing():
+    tracemalloc.stop()
+
+  TRACE.update(enabled=False, memory=False)
+
+  if trace_path is not None:
+    with open(trace_path, "w") as f:
+      json.dump({"pid": os.getpid(), "stages": TRACE["stages"]}, f, indent=2)
+
+  return TRACE["stages"]
+
+@contextlib.contextmanager
+def instrumentation(trace_path=None, profile_path=None, memory=False):
+  '''Context manager that enables instrumentation for its body and writes the JSON trace (and cProfile dump) on exit.
+  Stages run in worker processes are not traced, so run the pipeline with workers=1 to trace it.'''
+
+  enableInstrumentation(memory, profile=profile_path is not None)
+  try:
+    yield TRACE["stages"]
+  finally:
+    disableInstrumentation(trace_path, profile_path)
+
 """# Loading data from files and pre-processing"""
 
-# Loading csv files to variables
-BHM_raw = pd.read_csv("file_1.csv")
-control_raw = pd.read_csv("file_2.csv")
-both_BHM_age_raw = pd.read_csv("file_3.csv")
-both_not_BHM_age_raw = pd.read_csv("file_4.csv")
-both_strict_BHM_raw = pd.read_csv("file_5.csv")
-both_strict_not_BHM_raw = pd.read_csv("file_6.csv")
+# Survey 1 column labels, in export order: "Unnamed: xx" become "optional" answers, feature descriptions are cut, and some questions renamed for brevity
+SURVEY1_COLUMNS = ['Respondent ID', 'Collector ID', 'Start Date', 'End Date', 'IP Address',
+                   'Email Address', 'First Name', 'Last Name', 'Custom Data 1',
+                   'collector_type_source', 'Q1', 'Q2', "Q3", 'Q4', 'Q5','Q6', "Q7",'Q8', "Q9",
+                   'Q10','Q11','Q12','Q13',
+                   'Feature 1) AC2) RR', 'Feature 1) AC2) CR', 'Feature 1) AC2) SGT', 'Feature 1) AC2) JA',
+                   'Feature 1) RR 2) CR', 'Feature 1) RR 2) SGT', 'Feature 1) RR 2) JA',
+                   'Feature 1) CR 2) SGT', 'Feature 1) CR 2) JA', 'Feature 1) SGT 2) JA',
+                   'Pay Question', 'Buy Question', 'Q26', 'Age', 'Device Type', 'Gender']
+
+# Empty columns and repeat data columns
+SURVEY1_DROP_COLUMNS = ["IP Address", "Email Address", "First Name", "Last Name", "Age", "Gender"]
+
+# Datatype of every kept column, keyed by name. Answer codes are small (1-7) so fit in uint8,
+# free text and low-cardinality labels become categoricals
+SURVEY_DATE_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+SURVEY1_SCHEMA = {'Respondent ID': "int64",
+                  'Collector ID': "category",
+                  'Start Date': "datetime64[ns]",
+                  'End Date': "datetime64[ns]",
+                  'Custom Data 1': "category",
+                  'collector_type_source': "category",
+                  'Q1': "uint8",
+                  'Q2': "uint8",
+                  'Q3': "category",
+                  'Q4': "uint8",
+                  'Q5': "uint8",
+                  'Q6': "uint8",
+                  'Q7': "category",
+                  'Q8': "uint8",
+                  'Q9': "category",
+                  'Q10': "uint8",
+                  'Q11': "uint8",
+                  'Q12': "uint8",
+                  'Q13': "category",
+                  'Feature 1) AC2) RR': "uint8",
+                  'Feature 1) AC2) CR': "uint8",
+                  'Feature 1) AC2) SGT': "uint8",
+                  'Feature 1) AC2) JA': "uint8",
+                  'Feature 1) RR 2) CR': "uint8",
+                  'Feature 1) RR 2) SGT': "uint8",
+                  'Feature 1) RR 2) JA': "uint8",
+                  'Feature 1) CR 2) SGT': "uint8",
+                  'Feature 1) CR 2) JA': "uint8",
+                  'Feature 1) SGT 2) JA': "uint8",
+                  'Pay Question': "uint8",
+                  'Buy Question': "uint8",
+                  'Q26': "uint8",
+                  'Device Type': "category"}
+
+def castColumn(column, values, dtype):
+  '''Function that casts one column to a schema dtype. Integer columns must hold whole numbers within range, date columns are parsed with
+  SURVEY_DATE_FORMAT, and any failure is raised as a ValueError naming the column.
+  Input: column name, pandas Series object and dtype. Returns: pandas Series object'''
+
+  try:
+    if dtype == "datetime64[ns]":
+      return pd.to_datetime(values, format=SURVEY_DATE_FORMAT).astype(dtype) # pandas may infer a coarser unit
+
+    if pd.api.types.is_integer_dtype(dtype):
+      values = pd.to_numeric(values)
+      if values.isna().any():
+        raise ValueError("missing values")
+      if (values != np.trunc(values)).any():
+        raise ValueError("non-integer values")
+      limits = np.iinfo(dtype)
+      if ((values < limits.min) | (values > limits.max)).any():
+        raise ValueError(f"values outside {limits.min}..{limits.max}")
+
+    return values.astype(dtype)
+  except (ValueError, TypeError) as err:
+    raise ValueError(f"Column '{column}' cannot be cast to {dtype}: {err}") from err
+
+"""## Schema-driven cleaning plans
+
+A survey spec declares a survey's export layout: the name of every raw column in order (None-free; columns to discard
+are listed in "drop"), the dtype of every kept column, the columns whose answer is required (rows with it blank are
+removed, e.g. a skipped feature poll) and raw headings that must be present at given positions, to catch layout drift.
+"""
+
+SURVEY1_SPEC = {"name": "survey 1",
+                "columns": SURVEY1_COLUMNS,
+                "drop": SURVEY1_DROP_COLUMNS,
+                "schema": SURVEY1_SCHEMA,
+                "required": ['Feature 1) AC2) RR'], # NOTE: a skipped feature poll is detected from its first question
+                "headers": {0: "Respondent ID", 1: "Collector ID", 2: "Start Date", 3: "End Date",
+                            23: "Feature 1) and 2)", 33: "Pay Question", 34: "Buy Question"}}
+
+class CleaningPlan:
+  '''Class holding a survey spec compiled into positional column selections, so each export is checked, selected,
+  renamed, filtered and cast in one pass. Build with compileCleaningPlan().'''
+
+  def __init__(self, spec):
+    self.name = spec.get("name", "survey")
+    self.width = len(spec["columns"])
+    self.headers = dict(spec.get("headers", {}))
+
+    position = {column: i for i, column in enumerate(spec["columns"])}
+    if len(position) != self.width:
+      raise ValueError(f"{self.name}: spec has duplicate column names")
+
+    unknown = [column for column in [*spec["drop"], *spec["schema"], *spec.get("required", [])] if column not in position]
+    if unknown:
+      raise ValueError(f"{self.name}: spec refers to columns not in its layout: {unknown}")
+
+    kept = [column for column in spec["columns"] if column not in set(spec["drop"])]
+    untyped = [column for column in kept if column not in spec["schema"]]
+    if untyped:
+      raise ValueError(f"{self.name}: kept columns without a dtype: {untyped}")
 
-def cleaner1(df):
+    # (output name, raw position, dtype) per kept column, in schema order
+    self.selection = [(column, position[column], spec["schema"][column]) for column in spec["schema"] if column not in set(spec["drop"])]
+    self.required_positions = [position[column] for column in spec.get("required", [])]
+
+  def check(self, df):
+    '''Method that raises a ValueError if a raw export does not have the layout of the spec'''
+
+    if df.shape[1] != self.width:
+      raise ValueError(f"{self.name}: expected {self.width} columns in the export, found {df.shape[1]}")
+
+    for i, header in self.headers.items():
+      if df.columns[i] != header:
+        raise ValueError(f"{self.name}: expected column {i} of the export to be {header!r}, found {df.columns[i]!r}")
+
+  def apply(self, df, drop_label_row=True):
+    '''Method that cleans a raw export: checks its layout, keeps the rows that answered every required column
+    (and, with drop_label_row, not the repeat label row 0), then selects, renames and casts the kept columns.
+    Each kept column is filtered and cast once; the input is not modified.
+    Input: pandas DataFrame object. Returns: pandas DataFrame object'''
+
+    self.check(df)
+
+    keep_rows = np.ones(len(df), dtype=bool)
+    for i in self.required_positions:
+      keep_rows &= df.iloc[:, i].notna().to_numpy()
+    if drop_label_row:
+      keep_rows &= df.index != 0
+
+    index = df.index[keep_rows]
+    df_clean = pd.DataFrame({column: castColumn(column, pd.Series(df.iloc[:, i].to_numpy()[keep_rows], index=index), dtype)
+                             for column, i, dtype in self.selection}, index=index)
+
+    # Labeling axes
+    df_clean.index.name = "respondents"
+    df_clean.columns.name = "questions"
+
+    return df_clean
+
+def compileCleaningPlan(spec):
+  '''Function that validates a survey spec (see SURVEY1_SPEC) and compiles it into a CleaningPlan. Raises ValueError on an inconsistent spec'''
+
+  return CleaningPlan(spec)
+
+SURVEY1_PLAN = compileCleaningPlan(SURVEY1_SPEC)
+
+@instrumented(filters_rows=True)
+def cleaner1(df, drop_label_row=True):
   ''' Function that cleans up response data for survey 1 (BHM and control).
   Specifically: renames columns for brevity;
-  removes redundant and repeat columns and rows; removes rows with missing data; casts columns to specified datatypes;
-  and labels columns and index.
-  Input and returns: pandas DataFrame object'''
-
-  # Rename column labels: "Unnamed: xx" to "optional" answer, and cut descriptions of features, renaming some questions for brevity
-  df.columns = ['Respondent ID', 'Collector ID', 'Start Date', 'End Date', 'IP Address',
-       'Email Address', 'First Name', 'Last Name', 'Custom Data 1',
-       'collector_type_source', 'Q1', 'Q2', "Q3", 'Q4', 'Q5','Q6', "Q7",'Q8', "Q9",
-       'Q10','Q11','Q12','Q13','Q14','Q15','Q16','Q17','Q18', 'Q19','Q20', 'Q21','Q22','Q23','Q24',
-       'Q25','Q26','Age', 'Device Type', 'Gender']
-
-  # Remove empty columns and repeat columns
-  df_clean = df.drop(["IP Address", "Email Address", "First Name", "Last Name",
-                      "Age", "Gender"], axis=1) # <---- Repeat data columns
-
-  # Remove redundant first row of repeat labels
-  df_clean.drop(0, inplace=True)
-
-  # Delete skipped feature poll questions NOTE: This is evaluated if the first feature poll question is left blank.
-  df_clean.dropna(subset=['Feature 1) and 2)'], inplace=True)
-
-  # Casting columns to correct datatypes
-  # Forming converter dictionary from list of column headings then passing converter dictionary to DataFrame.astype() method
-  col_list = list(df_clean)
-  data_type_list = [int, int, str, str, str, str, int, int, str, int, int, int, str, int, str, int, int, int, str, int, int, int, int,
-                    int, int, int, int, int, int, int, int, int, str, int] # Specified data types per column
-
-  convert_dict = dict(zip(col_list, data_type_list))
-  df_clean = df_clean.astype(convert_dict)
-
-  # Labeling axes
-  df_clean.index.name = "respondents"
+  removes redundant and repeat columns and rows; removes rows with missing data; casts columns to the datatypes in SURVEY1_SCHEMA;
+  and labels columns and index. Runs the compiled SURVEY1_PLAN, so a changed export layout fails with a clear error.
+  Input and returns: pandas DataFrame object
+  optional arguments: drop_label_row=bool; remove the repeat label row (row 0). Only the first chunk of a chunked read contains it'''
+
+  return SURVEY1_PLAN.apply(df, drop_label_row)
+
+"""# Cleaned survey cache"""
+
+CLEANER1_VERSION = 4 # Bump whenever cleaner1() changes what it returns, so cached surveys are rebuilt
+SURVEY_CACHE_DIR = ".survey_cache"
+SURVEY_CACHE_MAX_BYTES = 2 * 1024**3
+SURVEY_CACHE_STALE_SECONDS = 3600 # Age after which a temporary cache file is taken to be left by an interrupted write
+
+def fileHash(path, block_size=2**20):
+  '''Function that returns the sha256 hex digest of a file's contents, read in blocks'''
+
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(block_size), b""):
+      digest.update(block)
+
+  return digest.hexdigest()
+
+def evictSurveyCache(cache_dir=SURVEY_CACHE_DIR, max_bytes=SURVEY_CACHE_MAX_BYTES, keep=()):
+  '''Function that deletes the least recently used cache files until the cache directory fits in max_bytes.
+  Temporary files of writes still in progress count towards the size; ones older than SURVEY_CACHE_STALE_SECONDS
+  were left by an interrupted write and are deleted. Files deleted meanwhile by another process are skipped.
+  optional arguments: keep=iterable of paths that must not be evicted (e.g. the file just written)'''
+
+  keep = {os.path.abspath(path) for path in keep}
+  now = time.time()
+  entries, total = [], 0
+
+  for entry in os.scandir(cache_dir):
+    try:
+      if not entry.is_file():
+        continue
+      info = entry.stat()
+      if entry.name.endswith(".tmp") and now - info.st_mtime > SURVEY_CACHE_STALE_SECONDS:
+        os.remove(entry.path)
+        continue
+    except FileNotFoundError:
+      continue
+
+    total += info.st_size
+    if entry.name.endswith(".feather") and os.path.abspath(entry.path) not in keep:
+      entries.append((info.st_mtime, info.st_size, entry.path))
+
+  for _, size, path in sorted(entries): # Oldest first
+    if total <= max_bytes:
+      break
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
+    total -= size
+
+@instrumented()
+def loadCleanSurvey1(path, cache_dir=SURVEY_CACHE_DIR, max_bytes=SURVEY_CACHE_MAX_BYTES):
+  '''Function that returns cleaner1() output for a survey 1 export, reading it from an on-disk Feather cache when possible.
+  The cache is keyed by the sha256 of the export and CLEANER1_VERSION, so a changed file or changed cleaning rules
+  rebuild it automatically. Cache hits are memory-mapped reads; least recently used files are evicted past max_bytes.
+  Requires pyarrow. Input: path to the .csv export. Returns: pandas DataFrame object'''
+
+  from pyarrow import feather
+
+  os.makedirs(cache_dir, exist_ok=True)
+  cache_path = os.path.join(cache_dir, f"{fileHash(path)}-v{CLEANER1_VERSION}.feather")
+
+  if os.path.exists(cache_path):
+    os.utime(cache_path) # Mark as recently used for eviction
+    table = feather.read_table(cache_path, memory_map=True)
+    df_clean = table.to_pandas(split_blocks=True).set_index("respondents")
+  else:
+    df_clean = cleaner1(pd.read_csv(path))
+
+    # Write to a temporary file first so an interrupted run never leaves a truncated cache entry
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    feather.write_feather(df_clean.reset_index(), temp_path, compression="uncompressed")
+    os.replace(temp_path, cache_path)
+    evictSurveyCache(cache_dir, max_bytes, keep=[cache_path])
+
   df_clean.columns.name = "questions"
 
   return df_clean
 
 """# Data Manipulation Functions"""
 
-def surv1FeatureScore(df_clean):
-  ''' Function that calculates the feature score per respondant. Input and returns: pandas DataFrame object'''
+# Feature poll layout: every respondent is asked to pick between each pair of features in a round-robin.
+# Each entry is (column heading, feature 1, feature 2); an answer of 1 scores feature 1, anything else scores feature 2.
+SURV1_FEATURES = ("AC", "RR", "CR", "SGT", "JA")
+SURV1_FEATURE_PAIRS = (("Feature 1) AC2) RR", "AC", "RR"),
+                       ("Feature 1) AC2) CR", "AC", "CR"),
+                       ("Feature 1) AC2) SGT", "AC", "SGT"),
+                       ("Feature 1) AC2) JA", "AC", "JA"),
+                       ("Feature 1) RR 2) CR", "RR", "CR"),
+                       ("Feature 1) RR 2) SGT", "RR", "SGT"),
+                       ("Feature 1) RR 2) JA", "RR", "JA"),
+                       ("Feature 1) CR 2) SGT", "CR", "SGT"),
+                       ("Feature 1) CR 2) JA", "CR", "JA"),
+                       ("Feature 1) SGT 2) JA", "SGT", "JA"))
 
-  # Creating a Dataframe of respondants' feature poll responses
-  features_only = df_clean[['Feature 1) AC2) RR',
-                            'Feature 1) AC2) CR',
-                            'Feature 1) AC2) SGT',
-                            'Feature 1) AC2) JA',
-                            'Feature 1) RR 2) CR',
-                            'Feature 1) RR 2) SGT',
-                            'Feature 1) RR 2) JA',
-                            'Feature 1) CR 2) SGT',
-                            'Feature 1) CR 2) JA',
-                            'Feature 1) SGT 2) JA']]
-
-  # Remove skipped answers
-  features_only = features_only.dropna()
-
-  # Creating data feature scores for each respondant as a list
-  data = []
-  for index, row in features_only.iterrows():
-
-    # Score board
-    score_hold = {"AC": 0, "RR": 0, "CR": 0, "SGT": 0, "JA": 0}
-    # Tally scores
-    if row["Feature 1) AC2) RR"] == 1:
-      score_hold["AC"] += 1
-    else:
-      score_hold["RR"] += 1
-    if row["Feature 1) AC2) CR"] == 1:
-      score_hold["AC"] += 1
-    else:
-      score_hold["CR"] += 1
-    if row["Feature 1) AC2) SGT"] == 1:
-      score_hold["AC"] += 1
-    else:
-      score_hold["SGT"] += 1
-    if row["Feature 1) AC2) JA"] == 1:
-      score_hold["AC"] += 1
-    else:
-      score_hold["JA"] += 1
-    #---------------------------------------------------------------------
-    if row["Feature 1) RR 2) CR"] == 1:
-      score_hold["RR"] += 1
-    else:
-      score_hold["CR"] += 1
-    if row["Feature 1) RR 2) SGT"] == 1:
-      score_hold["RR"] += 1
-    else:
-      score_hold["SGT"] += 1
-    if row["Feature 1) RR 2) JA"] == 1:
-      score_hold["RR"] += 1
-    else:
-      score_hold["JA"] += 1
-    #---------------------------------------------------------------------
-    if row["Feature 1) CR 2) SGT"] == 1:
-      score_hold["CR"] += 1
-    else:
-      score_hold["SGT"] += 1
-    if row["Feature 1) CR 2) JA"] == 1:
-      score_hold["CR"] += 1
-    else:
-      score_hold["JA"] += 1
-    #---------------------------------------------------------------------
-    if row["Feature 1) SGT 2) JA"] == 1:
-      score_hold["SGT"] += 1
-    else:
-      score_hold["JA"] += 1
+@functools.lru_cache(maxsize=None)
+def pairIncidenceMatrix(pairs, features):
+  '''Function that returns the pair-to-feature incidence matrix used to score a feature poll.
+  Rows 0..P-1 credit feature 1 of each pair (answer was 1), rows P..2P-1 credit feature 2 (any other answer).
+  Input: tuple of (column heading, feature 1, feature 2) tuples and a tuple of feature names. Returns: numpy array (2P x F)'''
 
-    # Add score board to data
-    data.append(list(score_hold.values()))
+  feature_index = {feature: i for i, feature in enumerate(features)}
+  incidence = np.zeros((2 * len(pairs), len(features)), dtype=np.int64)
 
-  # Create Dataframe
-  feature_scores = pd.DataFrame(data, columns=["AC", "RR", "CR", "SGT", "JA"],
-                                index=features_only.index)
+  for i, (_, first, second) in enumerate(pairs):
+    incidence[i, feature_index[first]] = 1
+    incidence[len(pairs) + i, feature_index[second]] = 1
 
-  return feature_scores
+  return incidence
 
-def surv1FeatScorePerPB(df_clean):
-  '''Function that returns the feature scores per pay bracket as a list of lists. Uses surv1FeatureScore() function.
-  Inner list is the feature scores in the order: AC, RR, CR, SGT, JA
-  Outer list is pay brackets in ascending order. '''
+def featureScore(df_clean, pairs, features):
+  '''Function that calculates the feature score per respondant for any round-robin feature poll.
+  Respondents who skipped any of the poll questions are left out.
+  Input: pandas DataFrame object, tuple of (column heading, feature 1, feature 2) tuples and a tuple of feature names.
+  Returns: pandas DataFrame object (respondents x features)'''
 
-  # list of dataframes, each containing respondent answers grouped by pay bracket, in ascending order of pay brackets
-  pay_bracket_resp_df_list = [ df_clean[df_clean["Pay Question"]==pb] for pb in range(1,8) ]
+  pairs, features = tuple(pairs), tuple(features)
 
-  # List of lists, each sublist containing the combined feature scores for each pay bracket in the order specified in function description
-  pay_bracket_resp__feat_score_df_list = [ list(surv1FeatureScore(x).sum()) for x in pay_bracket_resp_df_list ]
+  # Creating a Dataframe of respondants' feature poll responses and removing skipped answers
+  features_only = df_clean[[column for column, _, _ in pairs]].dropna()
 
-  return pay_bracket_resp__feat_score_df_list
+  # Respondent x pair matrix of choices: first half of the columns flags feature 1 picks, second half feature 2 picks
+  picked_first = features_only.to_numpy() == 1
+  choices = np.concatenate([picked_first, ~picked_first], axis=1).astype(np.int64)
 
-def surv1FeatScorePerBS(df_clean):
-  '''Function that returns the feature scores per living situation as a list of lists. Uses surv1FeatureScore() function.
-  Inner list is the feature scores in the order: ALB, BIF, UN, NB
-  Outer list is buying sentiment in the above order . '''
+  # One matrix product tallies every respondent's scores
+  scores = choices @ pairIncidenceMatrix(pairs, features)
 
-  # list of dataframes, each containing respondent answers grouped by Buying sentiment
-  living_situation_resp_df_list = [ df_clean[df_clean["Buy Question"]==ls] for ls in range(1,5) ]
+  return pd.DataFrame(scores, columns=list(features), index=features_only.index)
 
-  # List of lists, each sublist containing the combined feature scores for each buying sentiment in the order specified in function description
-  living_situation_resp_feat_score_df_list = [ list(surv1FeatureScore(x).sum()) for x in living_situation_resp_df_list ]
+@instrumented(filters_rows=True)
+def surv1FeatureScore(df_clean):
+  ''' Function that calculates the feature score per respondant. Input and returns: pandas DataFrame object'''
 
-  return living_situation_resp_feat_score_df_list
+  return featureScore(df_clean, SURV1_FEATURE_PAIRS, SURV1_FEATURES)
 
-"""# Custom Data Graphing Functions"""
+# Answer codes of the grouping questions, in ascending order
+PAY_BRACKETS = range(1, 8)
+BUY_SENTIMENTS = range(1, 5)
 
-def plotFeatScoreVsPay(y_values, which_survey="", percentage=False, line=False):
-  '''Fuction that plots a graph of feature scores per pay bracket.
-  The graph would have discreet price bands on x axis, and each band would have five plotted bars corresponding to different feature scores
-  Input: a list of lists containing feature scores per pay bracket,
-  optional arguments: which_survey=str; specify what survey is being plotted in graph title
-                      percentage=bool; have feature scores as a percentage of the sum of all feature scores for a given pay bracket,
-                      line=bool; visualise as line plot instead of bar (may be a good visualization tool) '''
+@instrumented()
+def surv1FeatScoreByGroup(df_clean, by, levels=None, feature_scores=None, weights=None):
+  '''Function that returns the total feature scores per group in a single pass over the respondents.
+  Input: pandas DataFrame object and the column name (or list of column names) to group by, e.g. ["Pay Question", "Buy Question"]
+  optional arguments: levels=iterable (or list of iterables, one per column); groups to report, in order. Groups nobody answered are filled with 0
+                      feature_scores=DataFrame; output of surv1FeatureScore() for df_clean, to avoid scoring the respondents again
+                      weights=Series; respondent weights indexed like df_clean (e.g. from rakeWeights()), to total weighted scores
+  Returns: pandas DataFrame object, one row per group (indexed by the group values) and one column per feature'''
 
-  plt.style.use("fivethirtyeight") # style selector
+  if isinstance(by, str):
+    by = [by]
+    levels = None if levels is None else [levels]
 
-  # Data and plotting
-  #-----------------------------------------------------------------------------
+  if feature_scores is None:
+    feature_scores = surv1FeatureScore(df_clean)
 
-  if percentage:
-    y_values_percent = [ [(element/sum(sublist))*100 for element in sublist] for sublist in y_values]
-    y_values = y_values_percent
+  if weights is not None:
+    feature_scores = feature_scores.mul(weights.reindex(feature_scores.index), axis=0)
 
+  # Group keys aligned to the scored respondents (skipped feature polls are already left out)
+  group_keys = [df_clean[column].reindex(feature_scores.index) for column in by]
+  group_scores = feature_scores.groupby(group_keys, observed=True).sum()
 
-  if line:
-    price_bands_indexes = np.arange(len(y_values)) # Generate a numpy array of consecutive integers' length equal to that of number of pay brackets
-    width = 0.1 # How much to space out your bars
+  if levels is not None:
+    if len(by) == 1:
+      full_index = pd.Index(list(levels[0]), name=by[0])
+    else:
+      full_index = pd.MultiIndex.from_product([list(level) for level in levels], names=by)
+    group_scores = group_scores.reindex(full_index, fill_value=0)
 
-    AC_scores = [sublist[0] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, AC_scores, color="#d01212", label="AC" )
+  return group_scores
 
-    RR_scores = [sublist[1] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, RR_scores, color="#23ba15", label="RR" )
+@instrumented()
+def surv1FeatScoreTotal(df_clean, weights=None):
+  '''Function that returns the total feature scores of a survey, optionally weighted per respondent (see rakeWeights()).
+  Unweighted, this is surv1FeatureScore(df_clean).sum(). Returns: pandas Series object'''
 
-    CR_scores = [sublist[2] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, CR_scores, color="#0d2aee", label="CR" )
+  feature_scores = surv1FeatureScore(df_clean)
 
-    SGT_scores = [sublist[3] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, SGT_scores, color="#ffbf00", label="SGT" )
+  if weights is not None:
+    return pd.Series(weights.reindex(feature_scores.index).to_numpy() @ feature_scores.to_numpy(), index=feature_scores.columns)
 
-    JA_scores = [sublist[4] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, JA_scores, color="#ec25cc", label="JA" )
+  return feature_scores.sum()
 
-  else:
-    price_bands_indexes = np.arange(len(y_values)) # Generate a numpy array of consecutive integers' length equal to that of number of pay brackets
-    width = 0.1 # How much to space out your bars
+@instrumented()
+def surv1FeatScorePerPB(df_clean, weights=None):
+  '''Function that returns the feature scores per pay bracket as a list of lists. Uses surv1FeatScoreByGroup() function.
+  Inner list is the feature scores in the order: AC, RR, CR, SGT, JA
+  Outer list is pay brackets in ascending order.
+  optional arguments: weights=Series; respondent weights (see rakeWeights()) '''
 
-    AC_scores = [sublist[0] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes-(2*width), AC_scores, width=width, color="#d01212", label="AC" )
+  return surv1FeatScoreByGroup(df_clean, "Pay Question", PAY_BRACKETS, weights=weights).values.tolist()
 
-    RR_scores = [sublist[1] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes-width, RR_scores, width=width, color="#23ba15", label="RR" )
+@instrumented()
+def surv1FeatScorePerBS(df_clean, weights=None):
+  '''Function that returns the feature scores per living situation as a list of lists. Uses surv1FeatScoreByGroup() function.
+  Inner list is the feature scores in the order: ALB, BIF, UN, NB
+  Outer list is buying sentiment in the above order .
+  optional arguments: weights=Series; respondent weights (see rakeWeights()) '''
 
-    CR_scores = [sublist[2] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes, CR_scores, width=width, color="#0d2aee", label="CR" )
+  return surv1FeatScoreByGroup(df_clean, "Buy Question", BUY_SENTIMENTS, weights=weights).values.tolist()
 
-    SGT_scores = [sublist[3] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes+width, SGT_scores, width=width, color="#ffbf00", label="SGT" )
+"""# Streaming ingest"""
 
-    JA_scores = [sublist[4] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes+(2*width), JA_scores, width=width, color="#ec25cc", label="JA" )
-  #-----------------------------------------------------------------------------
+class FeatureScoreAccumulator:
+  '''Class that keeps running feature score totals for a survey fed to it one piece at a time:
+  overall, per pay bracket and per buying sentiment. Only the totals are held, never the responses.'''
 
-  # Labelling
-  plt.legend()
+  def __init__(self, groups=None, weights=None):
+    '''optional arguments: groups=dict; column name -> levels to total over. Defaults to pay brackets and buying sentiment
+                        weights=Series; respondent weights indexed like the cleaned survey (see rakeWeights()), to total weighted scores.
+                        Chunks read by readSurvey1Chunks() keep the row index of the whole export, so weights line up'''
 
-  plt.xticks(ticks=price_bands_indexes,
-             labels=["Would not pay",
-                     "£0.01 -\n £0.99",
-                     "£1.00 -\n £2.99",
-                     "£3.00 -\n £4.99",
-                     "£5.00 -\n £6.99",
-                     "£7.00 -\n £9.99",
-                     "£10.00+"])
+    if groups is None:
+      groups = {"Pay Question": PAY_BRACKETS, "Buy Question": BUY_SENTIMENTS}
 
-  plt.title(f"Feature Scores per Price Band {which_survey}")
-  plt.xlabel("Price Band")
+    self.groups = {column: list(levels) for column, levels in groups.items()}
+    self.respondents = 0
+    self.last_respondent_id = None # Highest "Respondent ID" added so far
+    self.weights = weights
+    dtype = np.int64 if weights is None else float
+    self.total = pd.Series(0, index=list(SURV1_FEATURES), dtype=dtype)
+    self.per_group = {column: pd.DataFrame(0, index=pd.Index(levels, name=column), columns=list(SURV1_FEATURES), dtype=dtype)
+                      for column, levels in self.groups.items()}
 
-  if percentage:
-    plt.ylabel("Feature score (%)")
-  else:
-    plt.ylabel("Feature score")
+  def update(self, df_clean):
+    '''Method that scores a cleaned piece of the survey and adds it to the running totals. Returns the accumulator'''
 
-  plt.tight_layout()
+    feature_scores = surv1FeatureScore(df_clean)
 
-  plt.show()
+    self.respondents += len(feature_scores)
+    if self.weights is None:
+      self.total += feature_scores.sum()
+    else:
+      self.total += self.weights.reindex(feature_scores.index).to_numpy() @ feature_scores.to_numpy()
+    for column, levels in self.groups.items():
+      self.per_group[column] += surv1FeatScoreByGroup(df_clean, column, levels, feature_scores=feature_scores, weights=self.weights)
 
-def plotFeatScoreBuySent(y_values, which_survey="", percentage=False, line=False):
-  '''Fuction that plots a graph of feature scores per buying sentiment.
-  The graph would have buying sentiment opinions on x axis, and each opinion would have five plotted bars corresponding to different feature scores
-  Input: a list of lists containing feature scores per buying sentiment,
-  optional arguments: which_survey=str; specify what survey is being plotted in graph title
-                      percentage=bool; have feature scores as a percentage of the sum of all feature scores for a given buy sentiment,
-                      line=bool; visualise as line plot instead of bar (may be a good visualization tool) '''
+    if len(df_clean):
+      self.seen(df_clean["Respondent ID"].max())
 
-  plt.style.use("fivethirtyeight") # style selector
+    return self
 
-  # Data and plotting
-  #-----------------------------------------------------------------------------
+  def seen(self, respondent_id):
+    '''Method that records a respondent ID as processed, keeping the highest one seen'''
 
-  if percentage:
-    y_values_percent = [ [(element/sum(sublist))*100 for element in sublist] for sublist in y_values]
-    y_values = y_values_percent
+    if self.last_respondent_id is None or respondent_id > self.last_respondent_id:
+      self.last_respondent_id = int(respondent_id)
 
+  def toDict(self):
+    '''Method that returns the running totals as a JSON-serialisable dictionary. Weighted totals are not persisted,
+    since they cannot be continued without the weights'''
 
-  if line:
-    price_bands_indexes = np.arange(len(y_values)) # Generate a numpy array of consecutive integers' length equal to that of number of pay brackets
-    width = 0.1 # How much to space out your bars
+    if self.weights is not None:
+      raise ValueError("Weighted feature score totals cannot be saved")
 
-    AC_scores = [sublist[0] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, AC_scores, color="#d01212", label="AC" )
+    return {"respondents": self.respondents,
+            "last_respondent_id": self.last_respondent_id,
+            "total": self.total.tolist(),
+            "groups": {column: {"levels": levels, "scores": self.per_group[column].values.tolist()}
+                       for column, levels in self.groups.items()}}
 
-    RR_scores = [sublist[1] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, RR_scores, color="#23ba15", label="RR" )
+  @classmethod
+  def fromDict(cls, state):
+    '''Method that rebuilds an accumulator from the output of toDict()'''
 
-    CR_scores = [sublist[2] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, CR_scores, color="#0d2aee", label="CR" )
+    accumulator = cls({column: group["levels"] for column, group in state["groups"].items()})
+    accumulator.respondents = state["respondents"]
+    accumulator.last_respondent_id = state["last_respondent_id"]
+    accumulator.total[:] = state["total"]
+    for column, group in state["groups"].items():
+      accumulator.per_group[column][:] = group["scores"]
 
-    SGT_scores = [sublist[3] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, SGT_scores, color="#ffbf00", label="SGT" )
+    return accumulator
 
-    JA_scores = [sublist[4] for sublist in y_values] # y-axis data (as a list)
-    plt.plot(price_bands_indexes, JA_scores, color="#ec25cc", label="JA" )
+  def featScore(self):
+    '''Method that returns the total feature scores, as surv1FeatureScore(df_clean).sum() would'''
+    return self.total.copy()
 
-  else:
-    price_bands_indexes = np.arange(len(y_values)) # Generate a numpy array of consecutive integers' length equal to that of number of pay brackets
-    width = 0.1 # How much to space out your bars
+  def featScorePerPB(self):
+    '''Method that returns the feature scores per pay bracket, as surv1FeatScorePerPB() would'''
+    return self.per_group["Pay Question"].values.tolist()
 
-    AC_scores = [sublist[0] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes-(2*width), AC_scores, width=width, color="#d01212", label="AC" )
+  def featScorePerBS(self):
+    '''Method that returns the feature scores per buying sentiment, as surv1FeatScorePerBS() would'''
+    return self.per_group["Buy Question"].values.tolist()
 
-    RR_scores = [sublist[1] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes-width, RR_scores, width=width, color="#23ba15", label="RR" )
+def readSurvey1Chunks(path, chunksize=100000):
+  '''Generator that reads a survey 1 export in fixed-size chunks and yields each chunk cleaned by cleaner1().
+  The repeat label row only appears in the first chunk, so it is only dropped there.
+  Input: path to the .csv export, optional arguments: chunksize=int; number of raw rows per chunk'''
+
+  with pd.read_csv(path, chunksize=chunksize) as reader:
+    for chunk_number, chunk in enumerate(reader):
+      yield cleaner1(chunk, drop_label_row=(chunk_number == 0))
+
+def streamSurvey1(path, chunksize=100000, accumulator=None, weights=None):
+  '''Function that scores a survey 1 export chunk by chunk, so peak memory is bounded by the chunk size
+  rather than the size of the export.
+  Input: path to the .csv export, optional arguments: chunksize=int; number of raw rows per chunk
+                                                      accumulator=FeatureScoreAccumulator; add to existing totals
+                                                      weights=Series; respondent weights for a new accumulator (see rakeWeights())
+  Returns: FeatureScoreAccumulator object'''
+
+  if accumulator is None:
+    accumulator = FeatureScoreAccumulator(weights=weights)
+
+  for df_clean in readSurvey1Chunks(path, chunksize):
+    accumulator.update(df_clean)
+
+  return accumulator
+
+"""# Incremental refresh of live surveys"""
+
+class IncrementalFeatureScores:
+  '''Class that keeps running feature score totals per cohort across runs while a survey is live.
+  Each refresh only cleans and scores responses with a "Respondent ID" above the last one seen for that cohort
+  (SurveyMonkey assigns IDs in increasing order), and the totals are saved to a JSON state file between runs.'''
+
+  def __init__(self, state_path):
+    '''Input: path of the JSON state file. Saved totals are loaded if it exists'''
+
+    self.state_path = state_path
+    self.cohorts = {}
+
+    if os.path.exists(state_path):
+      with open(state_path) as f:
+        state = json.load(f)
+      self.cohorts = {name: FeatureScoreAccumulator.fromDict(cohort_state) for name, cohort_state in state["cohorts"].items()}
+
+  def refresh(self, cohort, path, chunksize=100000):
+    '''Method that adds the responses of an export that are newer than the cohort's last seen respondent.
+    The export is read in chunks and old rows are discarded before cleaner1(), so cleaning and scoring scale with the new responses.
+    Input: cohort name and path to its latest survey export. Returns: number of new respondents scored'''
+
+    accumulator = self.cohorts.setdefault(cohort, FeatureScoreAccumulator())
+    last_seen = accumulator.last_respondent_id
+    respondents_before = accumulator.respondents
+
+    with pd.read_csv(path, chunksize=chunksize) as reader:
+      for chunk in reader:
+        # The repeat label row has no numeric ID, so it is discarded along with already processed rows
+        respondent_ids = pd.to_numeric(chunk.iloc[:, 0], errors="coerce")
+        new_rows = respondent_ids > last_seen if last_seen is not None else respondent_ids.notna()
+
+        if new_rows.any():
+          accumulator.update(cleaner1(chunk[new_rows.to_numpy()], drop_label_row=False))
+          accumulator.seen(respondent_ids[new_rows].max()) # Also covers new rows dropped as skipped feature polls
+
+    return accumulator.respondents - respondents_before
+
+  def save(self):
+    '''Method that writes the running totals to the state file, replacing it atomically'''
+
+    temp_path = f"{self.state_path}.tmp"
+    with open(temp_path, "w") as f:
+      json.dump({"cohorts": {name: accumulator.toDict() for name, accumulator in self.cohorts.items()}}, f)
+    os.replace(temp_path, self.state_path)
+
+"""# Memory-mapped response matrix"""
+
+# Columns that get bitmap indexes by default: the ones analysts segment by
+RESPONSE_MATRIX_INDEX_COLUMNS = ["Q1", "Q2", "Device Type", "Collector ID", "Pay Question", "Buy Question"]
+
+def exportResponseMatrix(df_clean, path, index_columns=None):
+  '''Function that writes a cleaned survey as a packed uint8 answer matrix plus bitmap indexes, for fast repeated segment queries.
+  The directory gets: responses.npy (questions x respondents, one contiguous row per question), respondent_ids.npy,
+  bitmaps.npy (one packed bit row per indexed column value) and meta.json. The answer code (uint8) columns are stored,
+  feature poll included, plus the indexed categorical columns as category code + 1, with 0 for a missing answer.
+  Free text, ID and date columns are not stored.
+  Input: pandas DataFrame object (cleaner1() output) and output directory
+  optional arguments: index_columns=list; columns to build bitmap indexes for, defaults to RESPONSE_MATRIX_INDEX_COLUMNS
+  Returns: path'''
+
+  if index_columns is None:
+    index_columns = RESPONSE_MATRIX_INDEX_COLUMNS
+
+  os.makedirs(path, exist_ok=True)
+  columns = [column for column in df_clean.columns
+             if df_clean[column].dtype == np.uint8 or (column in index_columns and isinstance(df_clean[column].dtype, pd.CategoricalDtype))]
+  categories = {column: df_clean[column].cat.categories.tolist() for column in columns
+                if isinstance(df_clean[column].dtype, pd.CategoricalDtype)}
+
+  too_many = [column for column, values in categories.items() if len(values) > 255]
+  if too_many:
+    raise ValueError(f"Indexed columns with more than 255 categories do not fit in the uint8 matrix: {too_many}")
+
+  responses = np.lib.format.open_memmap(os.path.join(path, "responses.npy"), mode="w+", dtype=np.uint8,
+                                        shape=(len(columns), len(df_clean)))
+  for i, column in enumerate(columns):
+    if column in categories:
+      responses[i] = df_clean[column].cat.codes.to_numpy() + 1
+    else:
+      responses[i] = df_clean[column].to_numpy()
+  responses.flush()
+
+  np.save(os.path.join(path, "respondent_ids.npy"), df_clean["Respondent ID"].to_numpy())
+
+  # One packed bitmap per (indexed column, stored code)
+  bitmaps, bitmap_rows = [], {}
+  for column in index_columns:
+    row = responses[columns.index(column)]
+    bitmap_rows[column] = {}
+    for code in np.unique(row).tolist():
+      bitmap_rows[column][str(code)] = len(bitmaps)
+      bitmaps.append(np.packbits(row == code))
+  np.save(os.path.join(path, "bitmaps.npy"), np.array(bitmaps, dtype=np.uint8).reshape(len(bitmaps), -1))
+
+  with open(os.path.join(path, "meta.json"), "w") as f:
+    json.dump({"respondents": len(df_clean), "columns": columns, "categories": categories, "bitmaps": bitmap_rows}, f)
+
+  return path
+
+class ResponseMatrix:
+  '''Class that answers segment feature score queries from a directory written by exportResponseMatrix().
+  Everything is memory-mapped read-only, so any number of processes can query the same files without copying them.
+  A segment is a dictionary of column name -> accepted answers (matched against the bitmap indexes: OR within a column,
+  AND across columns).'''
+
+  def __init__(self, path):
+    with open(os.path.join(path, "meta.json")) as f:
+      meta = json.load(f)
+
+    self.respondents = meta["respondents"]
+    self.columns = meta["columns"]
+    self.categories = meta["categories"]
+    self.bitmap_rows = meta["bitmaps"]
+    self.responses = np.load(os.path.join(path, "responses.npy"), mmap_mode="r")
+    self.bitmaps = np.load(os.path.join(path, "bitmaps.npy"), mmap_mode="r")
+    self.respondent_ids = np.load(os.path.join(path, "respondent_ids.npy"), mmap_mode="r")
+
+    self._pair_rows = [self.columns.index(column) for column, _, _ in SURV1_FEATURE_PAIRS]
+    self._category_codes = {column: {str(category): i + 1 for i, category in enumerate(values)}
+                            for column, values in self.categories.items()}
+
+  def code(self, column, value):
+    '''Method that returns the stored code of an answer. Categories are matched by their text, so e.g. a Collector ID
+    matches whether given as int or str. Raises KeyError for a category the survey does not have'''
+
+    if column in self.categories:
+      codes = self._category_codes[column]
+      if str(value) not in codes:
+        raise KeyError(f"{value!r} is not an answer of column {column!r}")
+      return codes[str(value)]
+    return int(value)
+
+  def bitmap(self, segment=None):
+    '''Method that returns the packed bitmap of the respondents in a segment. None or {} selects everyone'''
+
+    selected = np.full(self.bitmaps.shape[1], 0xFF, dtype=np.uint8)
+
+    for column, values in (segment or {}).items():
+      if column not in self.bitmap_rows:
+        raise KeyError(f"Column {column!r} has no bitmap index")
+      rows = [self.bitmap_rows[column].get(str(self.code(column, value))) for value in values]
+      column_bits = np.zeros_like(selected)
+      for row in rows:
+        if row is not None: # Answers nobody gave have no bitmap
+          column_bits |= self.bitmaps[row]
+      selected &= column_bits
+
+    return selected
+
+  def mask(self, segment=None):
+    '''Method that returns the boolean mask of the respondents in a segment'''
+
+    return np.unpackbits(self.bitmap(segment), count=self.respondents).view(bool)
+
+  def featScore(self, segment=None, weights=None):
+    '''Method that returns the total feature scores of a segment, as surv1FeatureScore(subset).sum() would.
+    Only the feature poll rows of the matrix are read: each pair's feature 1 picks are counted over the segment
+    and turned into feature scores with the pair incidence matrix.
+    optional arguments: weights=numpy array; respondent weights in matrix order (see rakeWeights()), to total weighted picks'''
+
+    mask = self.mask(segment)
+
+    if weights is None:
+      picked_first = np.array([np.count_nonzero((self.responses[row] == 1) & mask) for row in self._pair_rows])
+      picked_second = np.count_nonzero(mask) - picked_first
+    else:
+      segment_weights = np.where(mask, np.asarray(weights, dtype=float), 0.0)
+      picked_first = np.array([(self.responses[row] == 1) @ segment_weights for row in self._pair_rows])
+      picked_second = segment_weights.sum() - picked_first
+
+    scores = np.concatenate([picked_first, picked_second]) @ pairIncidenceMatrix(SURV1_FEATURE_PAIRS, SURV1_FEATURES)
+    return pd.Series(scores, index=list(SURV1_FEATURES))
+
+  def featScoreByGroup(self, column, levels, segment=None, weights=None):
+    '''Method that returns the feature scores of a segment per level of a column, as a list of lists
+    in the same shape as surv1FeatScorePerPB()'''
+
+    return [self.featScore({**(segment or {}), column: [level]}, weights).tolist() for level in levels]
+
+"""# Cohort pipeline"""
+
+# Cohort registry: one entry per survey cohort, in reporting order. "path" is the cohort's survey export,
+# "title" labels the cohort's charts, "plots" maps each chart ("pay" per price band, "buy" per buying sentiment) to its plotting options
+COHORTS = {"BHM": {"path": "file_1.csv",
+                   "title": "(BHM survey)",
+                   "plots": {"pay": {"percentage": True}}},
+           "control": {"path": "file_2.csv",
+                       "title": "(Control survey)",
+                       "plots": {"pay": {"percentage": True}}},
+           "both_strict_BHM": {"path": "file_5.csv",
+                               "title": "(Both surveys: BHM Criteria)",
+                               "plots": {"pay": {"line": True}, "buy": {}}},
+           "both_strict_not_BHM": {"path": "file_6.csv",
+                                   "title": "(Both surveys: not BHM Criteria)",
+                                   "plots": {"pay": {"line": True}, "buy": {}}},
+           "both_BHM_age": {"path": "file_3.csv",
+                            "title": "(both surveys: Age range (25-34))",
+                            "plots": {"pay": {"line": True}, "buy": {}}},
+           "both_not_BHM_age": {"path": "file_4.csv",
+                                "title": "(both surveys: Outside age range (25-34))",
+                                "plots": {"pay": {"line": True}, "buy": {}}}}
+
+@dataclasses.dataclass
+class CohortResult:
+  '''Class holding the processed results of one cohort. Timings are wall-clock seconds per pipeline stage'''
+
+  name: str
+  respondents: int
+  featscore: pd.Series
+  featscore_perPB: list
+  featscore_perBS: list
+  timings: dict = dataclasses.field(default_factory=dict)
+
+def processCohort(name, path, chunksize=None, use_cache=False, weights=None):
+  '''Function that runs the clean -> score -> per pay bracket -> per buying sentiment sequence for one cohort.
+  Input: cohort name and path to its survey export
+  optional arguments: chunksize=int; stream the export in chunks of this many rows instead of loading it whole
+                      use_cache=bool; load the cleaned survey through loadCleanSurvey1()
+                      weights=Series; respondent weights indexed like the cleaned survey (see rakeWeights()), to total weighted scores
+  Returns: CohortResult object'''
+
+  timings = {}
+  stage_start = time.perf_counter()
+
+  def endStage(stage):
+    nonlocal stage_start
+    now = time.perf_counter()
+    timings[stage] = now - stage_start
+    stage_start = now
+
+  if chunksize:
+    accumulator = streamSurvey1(path, chunksize, weights=weights)
+    endStage("stream")
+    return CohortResult(name, accumulator.respondents, accumulator.featScore(),
+                        accumulator.featScorePerPB(), accumulator.featScorePerBS(), timings)
+
+  if use_cache:
+    df_clean = loadCleanSurvey1(path)
+    endStage("load")
+  else:
+    with stage("read_csv") as record:
+      df_raw = pd.read_csv(path)
+      record["rows_out"] = len(df_raw)
+    endStage("load")
+    df_clean = cleaner1(df_raw)
+    endStage("clean")
+
+  feature_scores = surv1FeatureScore(df_clean)
+  endStage("score")
+  featscore = (feature_scores.sum() if weights is None
+               else pd.Series(weights.reindex(feature_scores.index).to_numpy() @ feature_scores.to_numpy(), index=feature_scores.columns))
+  featscore_perPB = surv1FeatScoreByGroup(df_clean, "Pay Question", PAY_BRACKETS, feature_scores=feature_scores, weights=weights).values.tolist()
+  endStage("perPB")
+  featscore_perBS = surv1FeatScoreByGroup(df_clean, "Buy Question", BUY_SENTIMENTS, feature_scores=feature_scores, weights=weights).values.tolist()
+  endStage("perBS")
+
+  return CohortResult(name, len(feature_scores), featscore, featscore_perPB, featscore_perBS, timings)
+
+def runCohortPipeline(cohorts=None, workers=None, chunksize=None, use_cache=False, weights=None):
+  '''Function that processes every cohort in a registry concurrently on a process pool.
+  optional arguments: cohorts=dict; cohort registry in the format of COHORTS (the default)
+                      workers=int; number of worker processes, None for one per CPU, 1 to run serially in this process
+                      chunksize, use_cache; passed to processCohort()
+                      weights=dict; cohort name -> respondent weights (see rakeWeights()). Cohorts without weights are unweighted
+  Returns: dictionary of cohort name -> CohortResult, in registry order'''
+
+  if cohorts is None:
+    cohorts = COHORTS
+  if weights is None:
+    weights = {}
+
+  if workers == 1:
+    return {name: processCohort(name, spec["path"], chunksize, use_cache, weights.get(name)) for name, spec in cohorts.items()}
+
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = {name: pool.submit(processCohort, name, spec["path"], chunksize, use_cache, weights.get(name))
+               for name, spec in cohorts.items()}
+    return {name: future.result() for name, future in futures.items()}
+
+"""# Representation weighting"""
+
+def rakeWeights(df_clean, targets, max_iter=100, tol=1e-6):
+  '''Function that computes respondent weights that rebalance a survey to target marginal distributions
+  (raking / iterative proportional fitting), e.g. to correct an unrepresentative spread of respondents.
+  Each iteration rescales the weights to match one column's targets at a time, using a bincount per column.
+  Input: pandas DataFrame object and dictionary of column name -> {answer: target share}, e.g.
+         {"Q1": {1: 0.1, 2: 0.2, ...}, "Device Type": {...}}. Shares of a column are normalised to sum to 1
+  optional arguments: max_iter=int; iteration limit. tol=float; stop once every marginal is within tol of its target share
+  Returns: pandas Series object of weights indexed like df_clean, averaging 1. Warns (RuntimeWarning) if raking does not converge'''
+
+  codes, shares = [], []
+  for column, target in targets.items():
+    answers = pd.Index(list(target))
+    column_codes = answers.get_indexer(df_clean[column].to_numpy())
+
+    if (column_codes < 0).any():
+      unknown = sorted(set(df_clean[column][column_codes < 0].astype(str)))
+      raise ValueError(f"Column '{column}' has answers without a target share: {unknown}")
+    if len(np.unique(column_codes)) < len(answers):
+      missing = [answer for i, answer in enumerate(answers) if i not in set(column_codes.tolist())]
+      raise ValueError(f"Column '{column}' has target shares for answers nobody gave: {missing}")
+
+    target_shares = np.array(list(target.values()), dtype=float)
+    codes.append(column_codes)
+    shares.append(target_shares / target_shares.sum())
+
+  weights = np.ones(len(df_clean))
+  gap = np.inf
+
+  for _ in range(max_iter):
+    for column_codes, target_shares in zip(codes, shares):
+      totals = np.bincount(column_codes, weights=weights, minlength=len(target_shares))
+      weights *= (target_shares * weights.sum() / totals)[column_codes]
+
+    # Largest gap between achieved and target share across all columns
+    gap = max(np.abs(np.bincount(column_codes, weights=weights, minlength=len(target_shares)) / weights.sum() - target_shares).max()
+              for column_codes, target_shares in zip(codes, shares))
+    if gap < tol:
+      break
+  else:
+    warnings.warn(f"Raking did not converge in {max_iter} iterations: a marginal is still {gap:.2g} from its target share",
+                  RuntimeWarning, stacklevel=2)
+
+  return pd.Series(weights / weights.mean(), index=df_clean.index, name="weight")
+
+"""# Statistical differences between groups"""
+
+def featureShares(feature_scores):
+  '''Function that returns each feature's share of the total feature score (0 to 1).
+  Input: pandas DataFrame object (surv1FeatureScore() output) or numpy array (respondents x features). Returns: numpy array'''
+
+  totals = np.asarray(feature_scores, dtype=float).sum(axis=0)
+  return totals / totals.sum()
+
+def bootstrapShareDiffs(scores_a, scores_b, replicates, seed, max_batch_elements=2**24):
+  '''Function that returns bootstrap replicates of the difference in feature shares between two groups (a - b).
+  Each batch of replicates resamples the respondents of both groups with replacement as a matrix of
+  resample counts, so a whole batch is totalled with one matrix product per group.
+  Input: numpy arrays of per-respondent feature scores (respondents x features), number of replicates and a seed
+  optional arguments: max_batch_elements=int; cap on the size of a batch's count matrix, to bound memory
+  Returns: numpy array (replicates x features)'''
+
+  rng = np.random.default_rng(seed)
+  batch_size = max(1, max_batch_elements // max(len(scores_a), len(scores_b)))
+
+  diffs = []
+  for start in range(0, replicates, batch_size):
+    batch = min(batch_size, replicates - start)
+    shares = []
+    for scores in (scores_a, scores_b):
+      # Resample counts: draw respondent indexes, offset each replicate's row, and count them in one bincount
+      draws = rng.integers(0, len(scores), size=(batch, len(scores)))
+      draws += np.arange(batch)[:, None] * len(scores)
+      counts = np.bincount(draws.ravel(), minlength=batch * len(scores)).reshape(batch, len(scores))
+      totals = counts.astype(float) @ scores
+      shares.append(totals / totals.sum(axis=1, keepdims=True))
+    diffs.append(shares[0] - shares[1])
+
+  return np.concatenate(diffs)
+
+def permutationShareDiffs(scores_a, scores_b, replicates, seed, max_batch_elements=2**24):
+  '''Function that returns the difference in feature shares (a - b) under random relabelling of the pooled respondents,
+  i.e. the null distribution of no difference between the groups. Each batch of permutations is a boolean label matrix
+  totalled with one matrix product. Input and returns: as bootstrapShareDiffs()'''
+
+  rng = np.random.default_rng(seed)
+  pooled = np.concatenate([scores_a, scores_b])
+  pooled_totals = pooled.sum(axis=0)
+  batch_size = max(1, max_batch_elements // len(pooled))
+
+  diffs = []
+  for start in range(0, replicates, batch_size):
+    batch = min(batch_size, replicates - start)
+    labels = np.zeros((batch, len(pooled)), dtype=bool)
+    labels[:, :len(scores_a)] = True
+    rng.permuted(labels, axis=1, out=labels)
+
+    totals_a = labels.astype(float) @ pooled
+    totals_b = pooled_totals - totals_a
+    diffs.append(totals_a / totals_a.sum(axis=1, keepdims=True) - totals_b / totals_b.sum(axis=1, keepdims=True))
+
+  return np.concatenate(diffs)
+
+@instrumented()
+def compareFeatureShares(feature_scores_a, feature_scores_b, replicates=10000, confidence=0.95, seed=None, workers=None, task_size=1000):
+  '''Function that tests the difference in feature share between two groups of respondents, e.g. BHM vs control.
+  Confidence intervals come from bootstrap resampling, two-sided p-values from a permutation test.
+  Replicates are split into tasks of task_size, each with its own seed spawned from seed, so results are
+  reproducible and do not depend on the number of workers.
+  Input: surv1FeatureScore() output of each group
+  optional arguments: replicates=int; number of bootstrap and permutation replicates
+                      confidence=float; confidence level of the interval
+                      seed=int; seed of the random number generator
+                      workers=int; run the tasks on a process pool of this size, None or 1 to run in this process
+                      task_size=int; replicates per task
+  Returns: pandas DataFrame object, one row per feature with columns share_a, share_b, difference, ci_low, ci_high, p_value'''
+
+  scores_a = np.asarray(feature_scores_a, dtype=float)
+  scores_b = np.asarray(feature_scores_b, dtype=float)
+
+  task_replicates = [min(task_size, replicates - start) for start in range(0, replicates, task_size)]
+  seeds = np.random.SeedSequence(seed).spawn(2 * len(task_replicates))
+  bootstrap_tasks = [(bootstrapShareDiffs, scores_a, scores_b, n, task_seed) for n, task_seed in zip(task_replicates, seeds[::2])]
+  permutation_tasks = [(permutationShareDiffs, scores_a, scores_b, n, task_seed) for n, task_seed in zip(task_replicates, seeds[1::2])]
+
+  def run(tasks):
+    if workers is None or workers == 1:
+      return np.concatenate([function(*args) for function, *args in tasks])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      futures = [pool.submit(function, *args) for function, *args in tasks]
+      return np.concatenate([future.result() for future in futures])
+
+  share_a, share_b = featureShares(scores_a), featureShares(scores_b)
+  observed = share_a - share_b
+  bootstrap_diffs = run(bootstrap_tasks)
+  permutation_diffs = run(permutation_tasks)
+
+  alpha = 1 - confidence
+  ci_low, ci_high = np.quantile(bootstrap_diffs, [alpha / 2, 1 - alpha / 2], axis=0)
+  p_value = (1 + (np.abs(permutation_diffs) >= np.abs(observed)).sum(axis=0)) / (len(permutation_diffs) + 1)
+
+  features = getattr(feature_scores_a, "columns", SURV1_FEATURES)
+  return pd.DataFrame({"share_a": share_a, "share_b": share_b, "difference": observed,
+                       "ci_low": ci_low, "ci_high": ci_high, "p_value": p_value}, index=pd.Index(list(features), name="feature"))
+
+"""# Max Diff: Bradley-Terry feature utilities"""
+
+BT_PRIOR = 0.5 # Virtual wins given to each side of every pair, so features that always win or lose keep a finite utility
+
+@instrumented()
+def fitBradleyTerry(wins, comparisons, pairs=SURV1_FEATURE_PAIRS, features=SURV1_FEATURES, prior=BT_PRIOR, tol=1e-9, max_iter=10000):
+  '''Function that fits Bradley-Terry utilities to many independent sets of pairwise comparisons at once,
+  using minorization-maximization (MM) iterations vectorized across the sets.
+  Input: numpy arrays of wins per feature (sets x features) and of comparisons per pair (sets x pairs)
+  optional arguments: pairs, features; feature poll layout, as for featureScore()
+                      prior=float; virtual wins for each side of every pair
+                      tol=float; stop once no log utility changes by more than this
+                      max_iter=int; iteration limit
+  Returns: numpy array of log utilities (sets x features), each row centred on 0'''
+
+  pairs, features = tuple(pairs), tuple(features)
+  incidence = pairIncidenceMatrix(pairs, features)
+  first, second = incidence[:len(pairs)], incidence[len(pairs):] # pairs x features
+  members = first + second
+
+  # The prior adds a virtual win to each side of every pair that was compared
+  compared = (np.asarray(comparisons) > 0).astype(float)
+  comparisons = np.asarray(comparisons, dtype=float) + 2 * prior * compared
+  wins = np.asarray(wins, dtype=float) + prior * (compared @ members)
+  utilities = np.ones_like(wins)
+
+  for _ in range(max_iter):
+    # MM update: u_i <- wins_i / sum over pairs (i, j) of comparisons_ij / (u_i + u_j)
+    pair_rates = comparisons / (utilities @ first.T + utilities @ second.T)
+    updated = wins / (pair_rates @ members)
+    updated /= np.exp(np.log(updated).mean(axis=1, keepdims=True)) # Fix the scale: geometric mean of 1
+
+    change = np.abs(np.log(updated) - np.log(utilities)).max()
+    utilities = updated
+    if change < tol:
+      break
+
+  return np.log(utilities)
+
+@functools.lru_cache(maxsize=256)
+def cachedBradleyTerry(wins, comparisons, pairs=SURV1_FEATURE_PAIRS, features=SURV1_FEATURES, prior=BT_PRIOR):
+  '''Function that memoizes fitBradleyTerry() on hashable inputs (tuples of tuples for wins and comparisons),
+  so repeated segment queries do not re-fit. Returns: read-only numpy array of log utilities'''
+
+  utilities = fitBradleyTerry(np.array(wins), np.array(comparisons), pairs, features, prior)
+  utilities.setflags(write=False)
+  return utilities
+
+def surv1CohortUtilities(feature_scores, prior=BT_PRIOR):
+  '''Function that estimates the Bradley-Terry (logit) utility of each feature for a whole cohort.
+  Every respondent answers each pair once, so the cohort's total feature scores and respondent count are
+  sufficient statistics for the fit.
+  Input: pandas DataFrame object (surv1FeatureScore() output). Returns: pandas Series object of log utilities, NaN for an empty cohort'''
+
+  if feature_scores.empty:
+    return pd.Series(np.nan, index=feature_scores.columns, name="utility")
+
+  wins = tuple(int(total) for total in feature_scores.sum())
+  comparisons = (len(feature_scores),) * len(SURV1_FEATURE_PAIRS)
+  utilities = cachedBradleyTerry((wins,), (comparisons,), prior=prior)
+
+  return pd.Series(utilities[0], index=feature_scores.columns, name="utility")
+
+def surv1RespondentUtilities(feature_scores, prior=BT_PRIOR):
+  '''Function that estimates Bradley-Terry (logit) utilities of the features for every respondent.
+  A respondent's fit only depends on their feature scores, and there are few distinct score vectors,
+  so each distinct vector is fitted once (in one batch) and the results are mapped back to the respondents.
+  Input: pandas DataFrame object (surv1FeatureScore() output). Returns: pandas DataFrame object (respondents x features)'''
+
+  if feature_scores.empty:
+    return pd.DataFrame(index=feature_scores.index, columns=feature_scores.columns, dtype=float)
+
+  # Encode each score vector as one integer (scores are below the number of features) to find the distinct vectors quickly
+  scores = feature_scores.to_numpy()
+  codes = scores @ (scores.shape[1] ** np.arange(scores.shape[1]))
+  _, first_rows, inverse = np.unique(codes, return_index=True, return_inverse=True)
+  distinct = scores[first_rows]
+
+  wins = tuple(map(tuple, distinct.tolist()))
+  comparisons = ((1,) * len(SURV1_FEATURE_PAIRS),) * len(distinct)
+  utilities = cachedBradleyTerry(wins, comparisons, prior=prior)
+
+  return pd.DataFrame(utilities[inverse.ravel()], index=feature_scores.index, columns=feature_scores.columns)
+
+"""# Willingness to pay and premium tier pricing"""
+
+# Lowest price (GBP) each "Pay Question" bracket is willing to pay, in PAY_BRACKETS order ("Would not pay" is 0).
+# The lower bounds of the paying brackets are the candidate prices: a respondent accepts a price up to their bracket's lower bound
+PAY_BRACKET_MIN_PRICES = [0.00, 0.01, 1.00, 3.00, 5.00, 7.00, 10.00]
+
+@functools.lru_cache(maxsize=None)
+def bundleMatrix(features=SURV1_FEATURES):
+  '''Function that returns every non-empty feature bundle as (bundle names, bundles x features 0/1 numpy array)'''
+
+  bundles = [combination for size in range(1, len(features) + 1) for combination in itertools.combinations(features, size)]
+  membership = np.array([[feature in bundle for feature in features] for bundle in bundles], dtype=np.float32)
+  membership.setflags(write=False)
+
+  return ["+".join(bundle) for bundle in bundles], membership
+
+class WillingnessToPay:
+  '''Class that analyses willingness to pay over the "Pay Question" brackets of a survey: demand curves, the
+  revenue-maximising price, and which features to put in a premium tier. A respondent's willingness to pay (their bracket's
+  lowest price) is split across the features in proportion to their feature scores, so a bundle is worth the sum of its
+  features' shares to them, and they upgrade to it at any price up to that value. The features left out form the free tier.
+  Shared intermediate results (bracket membership, the highest price each respondent accepts for each bundle) are computed
+  once and memoized, so sweeping bundles and cohorts (masks) is cheap.'''
+
+  def __init__(self, df_clean, weights=None):
+    '''Input: pandas DataFrame object (cleaner1() output)
+    optional arguments: weights=Series; respondent weights indexed like df_clean (see rakeWeights())'''
+
+    self.feature_scores = surv1FeatureScore(df_clean)
+    self.prices = np.array(PAY_BRACKET_MIN_PRICES[1:])
+    self.weights = (np.ones(len(self.feature_scores)) if weights is None
+                    else weights.reindex(self.feature_scores.index).to_numpy(dtype=float))
+
+    # Bracket of every scored respondent as a code 0..6 (answers outside PAY_BRACKETS would pay nothing, -1)
+    self.bracket_codes = pd.Index(PAY_BRACKETS).get_indexer(df_clean["Pay Question"].reindex(self.feature_scores.index).to_numpy())
+    self.bracket_onehot = (self.bracket_codes[:, None] == np.arange(len(PAY_BRACKETS))).astype(np.float32)
+
+  @functools.cached_property
+  def price_levels(self):
+    '''Number of candidate prices each respondent would pay for each bundle (respondents x bundles, 0 = none)'''
+
+    scores = self.feature_scores.to_numpy()
+    willingness = np.where(self.bracket_codes >= 0, np.array(PAY_BRACKET_MIN_PRICES)[self.bracket_codes], 0.0)
+    value = willingness[:, None] * (scores @ bundleMatrix()[1].T.astype(np.int64)) / scores.sum(axis=1, keepdims=True)
+
+    return np.searchsorted(self.prices, value + 1e-9, side="right").astype(np.uint8) # Tolerance for rounding at a price
 
-    CR_scores = [sublist[2] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes, CR_scores, width=width, color="#0d2aee", label="CR" )
+  def _weights(self, mask):
+    return self.weights if mask is None else np.where(mask, self.weights, 0.0)
+
+  def bracketCounts(self, mask=None):
+    '''Method that returns the (weighted) number of respondents in each pay bracket. mask=boolean array selects a cohort'''
 
-    SGT_scores = [sublist[3] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes+width, SGT_scores, width=width, color="#ffbf00", label="SGT" )
+    return self._weights(mask) @ self.bracket_onehot
 
-    JA_scores = [sublist[4] for sublist in y_values] # y-axis data (as a list)
-    plt.bar(price_bands_indexes+(2*width), JA_scores, width=width, color="#ec25cc", label="JA" )
-  #-----------------------------------------------------------------------------
+  def demandCurve(self, mask=None):
+    '''Method that returns the cumulative demand curve: for each candidate price, the (weighted) respondents willing to pay it,
+    their share of all respondents, and the expected revenue per respondent. Shares and revenue are NaN for an empty cohort.
+    Returns: pandas DataFrame object indexed by price'''
 
-  # Labelling
-  plt.legend()
+    counts = self.bracketCounts(mask)
+    willing = np.cumsum(counts[::-1])[::-1][1:] # Respondents in the price's bracket or a higher one
+    share = willing / counts.sum() if counts.sum() > 0 else np.full(len(willing), np.nan)
 
-  plt.xticks(ticks=price_bands_indexes,
-             labels=["Label 1",
-                     "Label 2",
-                     "Label 3",
-                     "Label 4"])
+    return pd.DataFrame({"respondents": willing, "share": share, "revenue_per_respondent": self.prices * share},
+                        index=pd.Index(self.prices, name="price"))
 
-  plt.title(f"Feature Scores per BUY {which_survey}")
-  plt.xlabel("BS")
+  def optimalPrice(self, mask=None):
+    '''Method that returns the revenue-maximising candidate price and its demand curve row, as a pandas Series object.
+    All NaN, with no price, for an empty cohort'''
 
-  if percentage:
-    plt.ylabel("Feature score (%)")
-  else:
-    plt.ylabel("Feature score")
+    curve = self.demandCurve(mask)
+    if curve["revenue_per_respondent"].isna().all():
+      return pd.Series(np.nan, index=curve.columns)
 
-  plt.tight_layout()
+    return curve.loc[curve["revenue_per_respondent"].idxmax()].rename(curve["revenue_per_respondent"].idxmax())
 
-  plt.show()
-
-"""# Debug Window"""
+  def bundleDemand(self, mask=None):
+    '''Method that returns the share of respondents who would upgrade to each bundle at each candidate price
+    (all NaN for an empty cohort). Returns: pandas DataFrame object (bundles x prices)'''
+
+    weights = self._weights(mask)
+    levels = len(self.prices) + 1
+    adopters = np.array([np.bincount(self.price_levels[:, k], weights=weights, minlength=levels)
+                         for k in range(self.price_levels.shape[1])]) # bundles x highest accepted price level
+    willing = np.cumsum(adopters[:, ::-1], axis=1)[:, ::-1][:, 1:] # bundles x prices
 
-BHM = cleaner1(BHM_raw)
-# BHM
+    return pd.DataFrame(willing / weights.sum() if weights.sum() > 0 else np.full(willing.shape, np.nan),
+                        index=pd.Index(bundleMatrix()[0], name="bundle"), columns=pd.Index(self.prices, name="price"))
+
+  def bundleRevenue(self, mask=None, feature_cost=0.0):
+    '''Method that evaluates every bundle at every candidate price at once: the expected revenue per respondent
+    if the bundle is sold as the premium tier at that price.
+    optional arguments: feature_cost=float; cost per premium feature per upgrading respondent, deducted from the price
+    Returns: pandas DataFrame object (bundles x prices)'''
 
-surv1FeatScorePerPB(BHM)
+    demand = self.bundleDemand(mask)
+    return demand * self.prices - demand.mul(feature_cost * bundleMatrix()[1].sum(axis=1), axis=0)
 
-"""# Data clean and processing"""
+  def bundleSweep(self, mask=None, feature_cost=0.0):
+    '''Method that returns the best premium bundle of each size that leaves a free tier: the free tier, best price,
+    share of respondents upgrading and revenue per respondent at that price. A larger bundle is worth at least as much
+    as its subsets, so bundles are compared within a size; across sizes, compare with a feature_cost (see bundleRevenue()).
+    Putting every feature behind the paywall is optimalPrice(). Sizes nobody upgrades to are left out.
+    Returns: pandas DataFrame object indexed by bundle size'''
+
+    demand = self.bundleDemand(mask)
+    revenue = self.bundleRevenue(mask, feature_cost)
+    names, membership = bundleMatrix()
+    sizes = membership.sum(axis=1)
+
+    rows = {}
+    for size in range(1, membership.shape[1]):
+      of_size = sizes == size
+      if not (demand[of_size].to_numpy() > 0).any():
+        continue
+      bundle, price = revenue[of_size].stack().idxmax()
+      free = [feature for feature, member in zip(SURV1_FEATURES, membership[names.index(bundle)]) if not member]
+      rows[size] = {"bundle": bundle, "free_tier": "+".join(free), "best_price": price,
+                    "upgrade_share": demand.loc[bundle, price], "revenue_per_respondent": revenue.loc[bundle, price]}
+
+    columns = ["bundle", "free_tier", "best_price", "upgrade_share", "revenue_per_respondent"]
+    return pd.DataFrame.from_dict(rows, orient="index", columns=columns).rename_axis("size")
 
-# BHM survey variables
-BHM = cleaner1(BHM_raw) # Clean survey
+def sweepCohortBundles(cohorts, feature_cost=0.0):
+  '''Function that runs WillingnessToPay.bundleSweep() for several cohorts.
+  Input: dictionary of cohort name -> (WillingnessToPay object, boolean mask over its scored respondents or None).
+  Cohorts of one survey should share one WillingnessToPay object with different masks, so its memoized results are reused,
+  e.g. df_clean["Q1"].reindex(engine.feature_scores.index).isin([3]).to_numpy()
+  Returns: pandas DataFrame object indexed by (cohort, bundle size)'''
 
-BHM_featscore = surv1FeatureScore(BHM).sum() # Feature scores for each respondent
-BHM_featscore_perPB = surv1FeatScorePerPB(BHM) # Feature scores per pay bracket
-BHM_featscore_perBS = surv1FeatScorePerBS(BHM)
+  return pd.concat({name: engine.bundleSweep(mask, feature_cost) for name, (engine, mask) in cohorts.items()}, names=["cohort"])
 
-# Control survey variables
-control = cleaner1(control_raw) # Clean survey
+"""# Custom Data Graphing Functions"""
 
-control_featscore = surv1FeatureScore(control).sum() # Feature scores for each respondent
-control_featscore_perPB = surv1FeatScorePerPB(control) # Feature scores per pay bracket
-control_featscore_perBS = surv1FeatScorePerBS(control)
+PLOT_STYLE = "fivethirtyeight" # style selector
+FIGURE_SIZE = [12, 8]
+FIGURE_DPI = 100
+FEATURE_COLOURS = {"AC": "#d01212", "RR": "#23ba15", "CR": "#0d2aee", "SGT": "#ffbf00", "JA": "#ec25cc"}
+
+# Figure templates: x axis labels, title and x axis title for each kind of chart
+CHART_TEMPLATES = {"pay": {"labels": ["Would not pay",
+                                      "£0.01 -\n £0.99",
+                                      "£1.00 -\n £2.99",
+                                      "£3.00 -\n £4.99",
+                                      "£5.00 -\n £6.99",
+                                      "£7.00 -\n £9.99",
+                                      "£10.00+"],
+                           "title": "Feature Scores per Price Band {}",
+                           "xlabel": "Price Band"},
+                   "buy": {"labels": ["Label 1",
+                                      "Label 2",
+                                      "Label 3",
+                                      "Label 4"],
+                           "title": "Feature Scores per BUY {}",
+                           "xlabel": "BS"},
+                   "total": {"labels": list(SURV1_FEATURES),
+                             "title": "Total Feature Scores {}",
+                             "xlabel": None}}
+
+@instrumented()
+def drawFeatScores(ax, kind, y_values, which_survey="", percentage=False, line=False):
+  '''Fuction that draws a chart of feature scores onto a matplotlib Axes object.
+  "pay" and "buy" charts have one group per price band / buying sentiment on the x axis, each with one bar (or line point) per feature;
+  a "total" chart has one bar per feature.
+  Input: Axes object, chart kind (a key of CHART_TEMPLATES), and the feature scores:
+         a list of lists (one inner list per group) for "pay"/"buy", a list or Series of totals for "total"
+  optional arguments: which_survey=str; specify what survey is being plotted in graph title
+                      percentage=bool; have feature scores as a percentage of the sum of all feature scores for a given group,
+                      line=bool; visualise as line plot instead of bar (may be a good visualization tool) '''
 
-# both survey with strict BHM criteria
-both_strict_BHM = cleaner1(both_strict_BHM_raw) # Clean survey
+  template = CHART_TEMPLATES[kind]
+  colours = [FEATURE_COLOURS[feature] for feature in SURV1_FEATURES]
 
-both_strict_BHM_featscore = surv1FeatureScore(both_strict_BHM).sum() # Feature scores for each respondent
-both_strict_BHM_featscore_perPB = surv1FeatScorePerPB(both_strict_BHM) # Feature scores per pay bracket
-both_strict_BHM_featscore_perBS = surv1FeatScorePerBS(both_strict_BHM)
+  if kind == "total":
+    ax.bar(np.arange(len(SURV1_FEATURES)), np.asarray(y_values), color=colours)
+    ax.set_xticks(np.arange(len(SURV1_FEATURES)), labels=template["labels"])
+    ax.set_title(template["title"].format(which_survey))
+    ax.set_ylabel("Feature score")
+    return ax
 
-# both survey with strictly NOT BHM criteria
-both_strict_not_BHM = cleaner1(both_strict_not_BHM_raw) # Clean survey
+  # Data and plotting
+  #-----------------------------------------------------------------------------
+  y_values = np.asarray(y_values, dtype=float) # groups x features
 
-both_strict_not_BHM_featscore = surv1FeatureScore(both_strict_not_BHM).sum() # Feature scores for each respondent
-both_strict_not_BHM_featscore_perPB = surv1FeatScorePerPB(both_strict_not_BHM) # Feature scores per pay bracket
-both_strict_not_BHM_featscore_perBS = surv1FeatScorePerBS(both_strict_not_BHM)
+  if percentage:
+    with np.errstate(invalid="ignore", divide="ignore"):
+      y_values = y_values / y_values.sum(axis=1, keepdims=True) * 100
 
-# both survey BHM age
-both_BHM_age = cleaner1(both_BHM_age_raw) # Clean survey
+  group_indexes = np.arange(len(y_values)) # Generate a numpy array of consecutive integers' length equal to that of number of groups
+  width = 0.1 # How much to space out your bars
+  offsets = (np.arange(len(SURV1_FEATURES)) - (len(SURV1_FEATURES) - 1) / 2) * width # Bars are centred on each group
 
-both_BHM_age_featscore = surv1FeatureScore(both_BHM_age).sum() # Feature scores for each respondent
-both_BHM_age_featscore_perPB = surv1FeatScorePerPB(both_BHM_age) # Feature scores per pay bracket
-both_BHM_age_featscore_perBS = surv1FeatScoreBuySent(both_BHM_age)
+  for i, feature in enumerate(SURV1_FEATURES):
+    if line:
+      ax.plot(group_indexes, y_values[:, i], color=colours[i], label=feature)
+    else:
+      ax.bar(group_indexes + offsets[i], y_values[:, i], width=width, color=colours[i], label=feature)
+  #-----------------------------------------------------------------------------
 
-# both survey NOT BHM age
-both_not_BHM_age = cleaner1(both_not_BHM_age_raw) # Clean survey
+  # Labelling
+  ax.legend()
+  ax.set_xticks(group_indexes, labels=template["labels"])
+  ax.set_title(template["title"].format(which_survey))
+  ax.set_xlabel(template["xlabel"])
 
-both_not_BHM_age_featscore = surv1FeatureScore(both_not_BHM_age).sum() # Feature scores for each respondent
-both_not_BHM_age_featscore_perPB = surv1FeatScorePerPB(both_not_BHM_age) # Feature scores per pay bracket
-both_not_BHM_age_featscore_perBS = surv1FeatScorePerBS(both_not_BHM_age)
+  if percentage:
+    ax.set_ylabel("Feature score (%)")
+  else:
+    ax.set_ylabel("Feature score")
 
-"""# Data Graphing"""
+  return ax
 
-# Plot size parameters
-plt.rcParams['figure.figsize'] = [12, 8]
-plt.rcParams['figure.dpi'] = 100
+def plotFeatScores(kind, y_values, which_survey="", percentage=False, line=False):
+  '''Fuction that shows a chart of feature scores in a new pyplot figure, for interactive (notebook) use.
+  Uses the current pyplot style (the graphing section applies PLOT_STYLE once). See drawFeatScores() for the arguments'''
 
-"""### Pay Bracket
+  from matplotlib import pyplot as plt
 
-Single surveys
-"""
+  fig, ax = plt.subplots()
+  drawFeatScores(ax, kind, y_values, which_survey, percentage, line)
+  fig.tight_layout()
 
-# BHM Features score
-BHM_featscore.plot(kind="bar", title="Total Feature Scores (BHM Survey)")
+  plt.show()
 
-# BHM feature score per price band plot
-plotFeatScoreVsPay(BHM_featscore_perPB, "(BHM survey)", percentage=True)
+def plotFeatScoreVsPay(y_values, which_survey="", percentage=False, line=False):
+  '''Fuction that plots a graph of feature scores per pay bracket.
+  The graph would have discreet price bands on x axis, and each band would have five plotted bars corresponding to different feature scores
+  Input: a list of lists containing feature scores per pay bracket,
+  optional arguments: which_survey=str; specify what survey is being plotted in graph title
+                      percentage=bool; have feature scores as a percentage of the sum of all feature scores for a given pay bracket,
+                      line=bool; visualise as line plot instead of bar (may be a good visualization tool) '''
 
-# Control Features score
-control_featscore.plot(kind="bar", title="Total Feature Scores (Control Survey)")
+  plotFeatScores("pay", y_values, which_survey, percentage, line)
 
-# Control feature score per price band plot
-plotFeatScoreVsPay(control_featscore_perPB, "(Control survey)", percentage=True)
+def plotFeatScoreBuySent(y_values, which_survey="", percentage=False, line=False):
+  '''Fuction that plots a graph of feature scores per buying sentiment.
+  The graph would have buying sentiment opinions on x axis, and each opinion would have five plotted bars corresponding to different feature scores
+  Input: a list of lists containing feature scores per buying sentiment,
+  optional arguments: which_survey=str; specify what survey is being plotted in graph title
+                      percentage=bool; have feature scores as a percentage of the sum of all feature scores for a given buy sentiment,
+                      line=bool; visualise as line plot instead of bar (may be a good visualization tool) '''
 
-"""Both surveys: BHM criteria"""
+  plotFeatScores("buy", y_values, which_survey, percentage, line)
 
-# Both surveys with strict BHM criteria features score
-both_strict_BHM_featscore.plot(kind="bar", title="Total Feature Scores (both surveys: BHM criteria)")
+"""# Headless chart rendering"""
+
+def reportCharts(cohort_results, cohorts=None):
+  '''Function that lists the charts of a report: for every cohort, its total feature scores plus the charts in its registry "plots" entry.
+  Input: dictionary of cohort name -> CohortResult, optional arguments: cohorts=dict; cohort registry, defaults to COHORTS
+  Returns: list of chart dictionaries with keys name, kind, y_values, which_survey, percentage, line'''
+
+  if cohorts is None:
+    cohorts = COHORTS
+
+  charts = []
+  for name, result in cohort_results.items():
+    title = cohorts[name]["title"]
+    charts.append({"name": f"{name}_total", "kind": "total", "y_values": list(result.featscore), "which_survey": title})
+
+    chart_values = {"pay": result.featscore_perPB, "buy": result.featscore_perBS}
+    for kind, options in cohorts[name]["plots"].items():
+      charts.append({"name": f"{name}_{kind}", "kind": kind, "y_values": chart_values[kind], "which_survey": title, **options})
+
+  return charts
+
+def initRenderWorker():
+  '''Function that prepares a process for headless rendering: selects the Agg backend and applies the plot style once'''
+
+  import matplotlib
+  import matplotlib.style
+  matplotlib.use("Agg")
+  matplotlib.style.use(PLOT_STYLE)
+
+@instrumented()
+def renderChart(chart, out_dir, formats=("png",)):
+  '''Function that draws one chart on its own Figure (no pyplot state) and writes it to out_dir in each format, e.g. "png" or "svg".
+  Input: chart dictionary (see reportCharts()) and output directory. Returns: list of written file paths'''
+
+  from matplotlib.figure import Figure
+
+  fig = Figure(figsize=FIGURE_SIZE, dpi=FIGURE_DPI)
+  ax = fig.subplots()
+  drawFeatScores(ax, chart["kind"], chart["y_values"], chart.get("which_survey", ""),
+                 chart.get("percentage", False), chart.get("line", False))
+  fig.tight_layout()
+
+  paths = [os.path.join(out_dir, f"{chart['name']}.{file_format}") for file_format in formats]
+  for path in paths:
+    fig.savefig(path)
+
+  return paths
+
+def renderReport(charts, out_dir, formats=("png",), workers=None):
+  '''Function that renders a list of charts to files, in parallel worker processes.
+  Input: list of chart dictionaries (see reportCharts()) and output directory
+  optional arguments: formats=tuple of file formats; workers=int, None for one per CPU, 1 to render serially in this process
+  Returns: list of written file paths'''
+
+  os.makedirs(out_dir, exist_ok=True)
+
+  if workers == 1:
+    import matplotlib.style
+    with matplotlib.style.context(PLOT_STYLE):
+      return [path for chart in charts for path in renderChart(chart, out_dir, formats)]
+
+  with ProcessPoolExecutor(max_workers=workers, initializer=initRenderWorker) as pool:
+    rendered = pool.map(renderChart, charts, itertools.repeat(out_dir), itertools.repeat(formats))
+    return [path for paths in rendered for path in paths]
+
+"""# Synthetic data and benchmarks"""
+
+# Raw export headings in the layout cleaner1() expects: the feature poll is one question, so only its first column
+# has a heading and the rest are "Unnamed"; "optional" free text answers are "Unnamed" as well
+SURVEY1_RAW_COLUMNS = (['Respondent ID', 'Collector ID', 'Start Date', 'End Date', 'IP Address',
+                        'Email Address', 'First Name', 'Last Name', 'Custom Data 1', 'collector_type_source']
+                       + [f"Question {i}" if column not in ("Q3", "Q7", "Q9", "Q13") else f"Unnamed: {10 + i - 1}"
+                          for i, column in enumerate(SURVEY1_COLUMNS[10:23], start=1)]
+                       + ["Feature 1) and 2)"] + [f"Unnamed: {i}" for i in range(24, 33)]
+                       + ["Pay Question", "Buy Question", "Question 26", 'Age', 'Device Type', 'Gender'])
+
+def syntheticSurvey1(respondents, seed=None, skip_rate=0.05, first_id=10**10, label_row=True):
+  '''Function that generates a random survey 1 export in the raw layout cleaner1() expects, for testing and benchmarking.
+  Input: number of respondents
+  optional arguments: seed=int or numpy Generator; random seed
+                      skip_rate=float; share of respondents who skip the feature poll
+                      first_id=int; Respondent ID of the first respondent (IDs increase by 1)
+                      label_row=bool; start with the repeat label row, as a real export does
+  Returns: pandas DataFrame object with SURVEY1_RAW_COLUMNS'''
+
+  rng = np.random.default_rng(seed)
+  n = respondents
+
+  # A pool of timestamps is enough variety and avoids formatting millions of dates
+  date_pool = (pd.Timestamp("2020-10-01") + pd.to_timedelta(rng.integers(0, 30 * 86400, 1000), unit="s")).strftime(SURVEY_DATE_FORMAT)
+  start_dates = rng.choice(np.asarray(date_pool), n)
+
+  data = {"Respondent ID": np.arange(first_id, first_id + n),
+          "Collector ID": rng.choice([401234567, 401234568, 401234569], n),
+          "Start Date": start_dates,
+          "End Date": start_dates,
+          "IP Address": np.nan, "Email Address": np.nan, "First Name": np.nan, "Last Name": np.nan, "Custom Data 1": np.nan,
+          "collector_type_source": rng.choice(["weblink", "email", "audience"], n)}
+
+  for heading, column in zip(SURVEY1_RAW_COLUMNS[10:23], SURVEY1_COLUMNS[10:23]):
+    if SURVEY1_SCHEMA[column] == "category": # "Other (please specify)" text, mostly left blank
+      data[heading] = np.where(rng.random(n) < 0.02, "Other answer", None)
+    else:
+      data[heading] = rng.integers(1, 8, n)
+
+  # Feature poll: 1 picks feature 1, 2 picks feature 2
+  poll = rng.integers(1, 3, (n, len(SURV1_FEATURE_PAIRS))).astype(float)
+  poll[rng.random(n) < skip_rate] = np.nan
+  for i, heading in enumerate(SURVEY1_RAW_COLUMNS[23:33]):
+    data[heading] = poll[:, i]
+
+  data["Pay Question"] = rng.integers(1, 8, n)
+  data["Buy Question"] = rng.integers(1, 5, n)
+  data["Question 26"] = rng.integers(1, 6, n)
+  data["Age"] = rng.choice(["18-29", "30-44", "45-60", "> 60"], n)
+  data["Device Type"] = rng.choice(["iOS Phone / Tablet", "Android Phone / Tablet", "Windows Desktop / Laptop", "MacOS Desktop / Laptop"], n)
+  data["Gender"] = rng.choice(["Male", "Female"], n)
+
+  df = pd.DataFrame(data, columns=SURVEY1_RAW_COLUMNS)
+
+  if label_row:
+    labels = pd.DataFrame([["Response"] * 10 + ["Response"] * 13
+                           + [f"{first}) {second}" for _, first, second in SURV1_FEATURE_PAIRS]
+                           + ["Response"] * 6], columns=SURVEY1_RAW_COLUMNS)
+    df = pd.concat([labels, df], ignore_index=True)
+
+  return df
+
+def writeSyntheticSurvey1(path, respondents, seed=None, chunksize=1000000, **kwargs):
+  '''Function that writes a synthetic survey 1 export to a .csv file in chunks, so memory stays bounded for any size.
+  Input: output path and number of respondents, optional arguments: seed=int, chunksize=int; respondents per chunk,
+  other keyword arguments are passed to syntheticSurvey1(). Returns: path'''
+
+  rng = np.random.default_rng(seed)
+
+  for start in range(0, respondents, chunksize):
+    chunk = syntheticSurvey1(min(chunksize, respondents - start), rng, first_id=10**10 + start, label_row=(start == 0), **kwargs)
+    chunk.to_csv(path, mode="w" if start == 0 else "a", header=(start == 0), index=False)
+
+  return path
+
+BENCHMARK_SIZES = (1000, 100000, 10000000)
+BENCHMARK_IN_MEMORY_LIMIT = 2000000 # Above this many respondents only the streaming stage is benchmarked
+
+def measureStage(function, *args, profile_memory=True):
+  '''Function that runs function(*args) and measures its wall time and, optionally, its peak traced memory.
+  Memory is measured in a second, separate run so tracing does not distort the timing.
+  Returns: (result, dictionary with wall_seconds and peak_bytes)'''
+
+  start = time.perf_counter()
+  result = function(*args)
+  measurement = {"wall_seconds": time.perf_counter() - start, "peak_bytes": None}
+
+  if profile_memory:
+    del result
+    tracemalloc.start()
+    result = function(*args)
+    measurement["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  return result, measurement
+
+def runBenchmarks(sizes=BENCHMARK_SIZES, work_dir=".benchmarks", results_path=None, seed=0, profile_memory=True, chunksize=100000):
+  '''Function that times and memory-profiles each stage of the pipeline on synthetic exports of each size.
+  Synthetic exports are written once per size and reused by later runs.
+  optional arguments: sizes=iterable of respondent counts; work_dir=str, where synthetic exports are kept
+                      results_path=str; also write the results there as JSON; seed=int; profile_memory=bool
+                      chunksize=int; chunk size of the streaming stage
+  Returns: dictionary with the environment and a list of results, one per size and stage'''
+
+  os.makedirs(work_dir, exist_ok=True)
+  results = []
+
+  for size in sizes:
+    path = os.path.join(work_dir, f"survey1_{size}_seed{seed}.csv")
+    if not os.path.exists(path):
+      writeSyntheticSurvey1(path, size, seed)
+
+    def record(stage, function, *args):
+      result, measurement = measureStage(function, *args, profile_memory=profile_memory)
+      results.append({"respondents": size, "stage": stage, **measurement})
+      return result
+
+    if size <= BENCHMARK_IN_MEMORY_LIMIT:
+      df_raw = record("read_csv", pd.read_csv, path)
+      df_clean = record("cleaner1", cleaner1, df_raw)
+      record("surv1FeatureScore", surv1FeatureScore, df_clean)
+      record("surv1FeatScorePerPB", surv1FeatScorePerPB, df_clean)
+      record("surv1FeatScorePerBS", surv1FeatScorePerBS, df_clean)
+      record("surv1FeatScoreByGroup PBxBS", surv1FeatScoreByGroup, df_clean, ["Pay Question", "Buy Question"])
+      del df_raw, df_clean
+
+    record("streamSurvey1", streamSurvey1, path, chunksize)
+
+  report = {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.machine(), "results": results}
+
+  if results_path is not None:
+    with open(results_path, "w") as f:
+      json.dump(report, f, indent=2)
+
+  return report
+
+def compareBenchmarks(baseline, current, tolerance=0.25):
+  '''Function that flags stages that got slower or used more memory than a baseline benchmark run.
+  Input: two runBenchmarks() reports (or paths to their JSON files)
+  optional arguments: tolerance=float; allowed relative increase before a stage is flagged
+  Returns: list of dictionaries describing each regression (empty if none)'''
+
+  reports = []
+  for report in (baseline, current):
+    if isinstance(report, str):
+      with open(report) as f:
+        report = json.load(f)
+    reports.append({(result["respondents"], result["stage"]): result for result in report["results"]})
+
+  regressions = []
+  for key, result in reports[1].items():
+    if key not in reports[0]:
+      continue
+    for metric in ("wall_seconds", "peak_bytes"):
+      before, after = reports[0][key][metric], result[metric]
+      if before and after and after > before * (1 + tolerance):
+        regressions.append({"respondents": key[0], "stage": key[1], "metric": metric, "baseline": before, "current": after})
+
+  return regressions
 
-# Both surveys with strict BHM criteria features score per price band
-plotFeatScoreVsPay(both_strict_BHM_featscore_perPB, "(Both surveys: BHM Criteria)", percentage=False, line=True)
+"""# Data clean and processing"""
 
-# Both surveys with strict BHM criteria features score per buying sentiment
-plotFeatScoreBuySent(both_strict_BHM_featscore_perBS, "(Both surveys: BHM Criteria)", percentage=False, line=False)
+def printCohortSummary(cohort_results):
+  '''Function that prints the respondents and per-stage timings (seconds) of each cohort'''
 
+  for name, result in cohort_results.items():
+    print(f"{name}: {result.respondents} respondents, " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result.timings.items()))
 
+"""# Data Graphing"""
 
-# Both surveys with strictly NOT BHM criteria features score
-both_strict_not_BHM_featscore.plot(kind="bar", title="Total Feature Scores (both surveys: not BHM criteria)")
+def showReport(cohort_results, cohorts=None):
+  '''Function that shows the total feature scores, feature scores per price band, and per buying sentiment, for each cohort,
+  as interactive pyplot figures (e.g. inline in a notebook). optional arguments: cohorts=dict; cohort registry, defaults to COHORTS'''
 
-# Both surveys with strictly NOT BHM criteria features score per price band
-plotFeatScoreVsPay(both_strict_not_BHM_featscore_perPB, "(Both surveys: not BHM Criteria)", percentage=False, line=True)
+  from matplotlib import pyplot as plt
 
-# Both surveys with strictly NOT BHM criteria features score buy sentiment
-plotFeatScoreBuySent(both_strict_not_BHM_featscore_perBS, "(Both surveys: not BHM Criteria)", percentage=False, line=False)
+  if cohorts is None:
+    cohorts = COHORTS
 
-"""Both Surveys: BHM age"""
+  # Plot style and size parameters
+  plt.style.use(PLOT_STYLE)
+  plt.rcParams['figure.figsize'] = FIGURE_SIZE
+  plt.rcParams['figure.dpi'] = FIGURE_DPI
 
-# Both surveys BHM age features score
-both_BHM_age_featscore.plot(kind="bar", title="Total Feature Scores (both surveys: Age range (25-34))")
+  for name, result in cohort_results.items():
+    title = cohorts[name]["title"]
+    plots = cohorts[name]["plots"]
 
-# Both surveys BHM age feature score per price band
-plotFeatScoreVsPay(both_BHM_age_featscore_perPB, "(both surveys: Age range (25-34))", percentage=False, line=True)
+    plotFeatScores("total", result.featscore, title)
 
-# Both surveys BHM age feature score per buying sentiment
-plotFeatScoreBuySent(both_BHM_age_featscore_perBS, "(both surveys: Age range (25-34))", percentage=False, line=False)
+    if "pay" in plots:
+      plotFeatScoreVsPay(result.featscore_perPB, title, **plots["pay"])
 
+    if "buy" in plots:
+      plotFeatScoreBuySent(result.featscore_perBS, title, **plots["buy"])
 
+"""# Command-line entry point
 
-# Both surveys not BHM age features score
-both_not_BHM_age_featscore.plot(kind="bar", title="Total Feature Scores (both surveys: Outside age range (25-34))")
+In a notebook, run the analysis with:
 
-# Both surveys not BHM age feature score per price band
-plotFeatScoreVsPay(both_not_BHM_age_featscore_perPB, "(both surveys: Outside age range (25-34))", percentage=False, line=True)
+    cohort_results = runCohortPipeline(COHORTS)
+    printCohortSummary(cohort_results)
+    showReport(cohort_results)
+"""
 
-# Both surveys not BHM age feature score per buying sentiment
-plotFeatScoreBuySent(both_not_BHM_age_featscore_perBS, "(both surveys: Outside age range (25-34))", percentage=False, line=False)
+OUTPUT_FORMATS = ("csv", "json", "png", "svg")
+
+def resolveInputs(inputs, cohorts=None):
+  '''Function that points the cohort registry at the files given on the command line.
+  Each input is either a path/glob, whose files are matched to registry entries by file name (e.g. data/*.csv),
+  or NAME=PATH to set the export of one cohort.
+  Returns: cohort registry, a copy with updated paths'''
+
+  cohorts = {name: dict(spec) for name, spec in (COHORTS if cohorts is None else cohorts).items()}
+  by_file_name = {os.path.basename(spec["path"]): name for name, spec in cohorts.items()}
+
+  for pattern in inputs:
+    name, _, path = pattern.rpartition("=")
+
+    if name:
+      if name not in cohorts:
+        raise ValueError(f"Unknown cohort {name!r}")
+      cohorts[name]["path"] = path
+      continue
+
+    paths = sorted(glob.glob(path)) or [path]
+    for path in paths:
+      if os.path.basename(path) not in by_file_name:
+        raise ValueError(f"{path} does not match any cohort file name; use NAME={path}")
+      cohorts[by_file_name[os.path.basename(path)]]["path"] = path
+
+  return cohorts
+
+def writeResults(cohort_results, out_dir, formats=("csv", "json")):
+  '''Function that writes the feature scores of every cohort to out_dir:
+  "csv" writes feature_scores.csv (one row per cohort and group), "json" writes results.json (scores, respondents and timings).
+  Returns: list of written file paths'''
+
+  os.makedirs(out_dir, exist_ok=True)
+  paths = []
+
+  if "csv" in formats:
+    rows = []
+    for name, result in cohort_results.items():
+      rows.append([name, "total", None, *result.featscore.tolist()])
+      rows += [[name, "Pay Question", level, *scores] for level, scores in zip(PAY_BRACKETS, result.featscore_perPB)]
+      rows += [[name, "Buy Question", level, *scores] for level, scores in zip(BUY_SENTIMENTS, result.featscore_perBS)]
+
+    table = pd.DataFrame(rows, columns=["cohort", "group", "level", *SURV1_FEATURES]).astype({"level": "Int64"})
+    paths.append(os.path.join(out_dir, "feature_scores.csv"))
+    table.to_csv(paths[-1], index=False)
+
+  if "json" in formats:
+    paths.append(os.path.join(out_dir, "results.json"))
+    with open(paths[-1], "w") as f:
+      json.dump({name: {"respondents": result.respondents,
+                        "featscore": result.featscore.tolist(),
+                        "featscore_perPB": result.featscore_perPB,
+                        "featscore_perBS": result.featscore_perBS,
+                        "timings": result.timings} for name, result in cohort_results.items()}, f, indent=2)
+
+  return paths
+
+def main(argv=None):
+  '''Command-line entry point: scores the selected cohorts and writes tables and charts for them'''
+
+  parser = argparse.ArgumentParser(description="Feature score analysis of the survey 1 exports.")
+  parser.add_argument("inputs", nargs="*",
+                      help="survey exports: paths or globs matched to cohorts by file name, or NAME=PATH (default: the registry paths)")
+  parser.add_argument("--cohorts", nargs="+", choices=list(COHORTS), default=list(COHORTS), metavar="COHORT",
+                      help=f"cohorts to process (default: all of {', '.join(COHORTS)})")
+  parser.add_argument("--output-dir", default="output", help="directory for the results (default: output)")
+  parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU, 1 runs serially)")
+  parser.add_argument("--formats", nargs="+", choices=OUTPUT_FORMATS, default=["csv", "json"],
+                      help="outputs to write (default: csv json); png/svg render the charts")
+  parser.add_argument("--chunksize", type=int, default=None, help="stream each cohort export in chunks of this many rows")
+  parser.add_argument("--cache", action="store_true", help="read cleaned surveys through the Feather cache")
+  parser.add_argument("--trace", metavar="PATH", help="record a JSON stage trace (runs serially)")
+  parser.add_argument("--trace-memory", action="store_true", help="also record peak memory per stage in the trace (slower)")
+  parser.add_argument("--profile", metavar="PATH", help="dump cProfile statistics (runs serially)")
+  parser.add_argument("--colab-drive", action="store_true", help="mount Google Drive first (Google Colaboratory only)")
+  args = parser.parse_args(argv)
+
+  if args.trace_memory and not args.trace:
+    parser.error("--trace-memory requires --trace")
+
+  if args.colab_drive:
+    mountGoogleDrive()
+
+  try:
+    cohorts = resolveInputs(args.inputs)
+  except ValueError as err:
+    parser.error(str(err))
+  cohorts = {name: cohorts[name] for name in args.cohorts}
+
+  missing = [path for path in dict.fromkeys(spec["path"] for spec in cohorts.values()) if not os.path.isfile(path)]
+  if missing:
+    parser.error(f"survey exports not found: {', '.join(missing)}")
+
+  # Stages in worker processes are not traced, so tracing runs in this process
+  workers = 1 if (args.trace or args.profile) else args.workers
+
+  with (instrumentation(args.trace, args.profile, args.trace_memory) if (args.trace or args.profile) else contextlib.nullcontext()):
+    cohort_results = runCohortPipeline(cohorts, workers, args.chunksize, args.cache)
+    paths = writeResults(cohort_results, args.output_dir, args.formats)
+
+    chart_formats = [file_format for file_format in args.formats if file_format in ("png", "svg")]
+    if chart_formats:
+      paths += renderReport(reportCharts(cohort_results, cohorts), args.output_dir, chart_formats, workers)
+
+  printCohortSummary(cohort_results)
+  for path in paths:
+    print(f"wrote {path}")
+
+  return 0
+
+if __name__ == "__main__" and "ipykernel" not in sys.modules:
+  sys.exit(main())